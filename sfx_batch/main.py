@@ -1,11 +1,20 @@
 import typer
 from typing_extensions import Annotated
+import asyncio
 import logging
 from pathlib import Path
+from typing import Awaitable, Callable, Iterable, Iterator, TypeVar
 import os
-import csv
+import queue
+import random
+import threading
 import codecs # For BOM handling
-from dotenv import load_dotenv
+import contextlib
+import importlib.util
+import itertools
+from collections import Counter
+from enum import Enum
+from dotenv import find_dotenv, load_dotenv
 # Import specific components from the actual elevenlabs_sfx library
 from elevenlabs_sfx.client import ElevenLabsSFXClient
 from elevenlabs_sfx.exceptions import (
@@ -18,7 +27,17 @@ from elevenlabs_sfx.exceptions import (
 )
 
 
-from .utils import sanitize_filename, get_unique_filepath
+from .utils import (
+    sanitize_filename,
+    FilenameAllocator,
+    TokenBucket,
+    get_retry_after,
+    get_cache_key,
+    store_cache_entry,
+    iter_csv_rows,
+    iter_arrow_csv_rows,
+    write_new_file,
+)
 
 # Configure logging
 logging.basicConfig(
@@ -28,6 +47,29 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+
+class CSVEngine(str, Enum):
+    """Parser used to read the input CSV file."""
+    python = "python"
+    pyarrow = "pyarrow"
+
+
+# Exponential backoff for retried API calls: min(CAP, BASE * 2**attempt) seconds plus
+# up to BASE seconds of random jitter.
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_CAP = 30.0
+
+# Read buffer for the input CSV. Much larger than Python's 8 KiB default to cut the
+# number of read() syscalls on multi-MB prompt lists.
+DEFAULT_READ_BUFFER_SIZE = 1 << 20 # 1 MiB
+
+# Rows validated per vectorized pass by iter_prompts_vectorized.
+VALIDATION_CHUNK_ROWS = 4096
+# Strings accepted by float() (minus digit-group underscores), in RE2 syntax for pyarrow.compute.
+_FLOAT_PATTERN = r"(?i)^[+-]?((\d+\.?\d*|\.\d+)(e[+-]?\d+)?|inf(inity)?|nan)$"
+
 app = typer.Typer(
     name="sfx-batch",
     help="CLI tool for batch sound effects generation using the elevenlabs-sfx library.",
@@ -71,8 +113,533 @@ def get_api_key(api_key_arg: str | None) -> str | None:
     return None
 
 
+class _RowIssues:
+    """
+    Tallies per-row CSV problems by kind, remembering the first few row numbers of each,
+    so they can be reported as one aggregated warning per kind.
+    """
+
+    def __init__(self, max_examples: int = 5):
+        self.counts: Counter[str] = Counter()
+        self.first_rows: dict[str, list[int]] = {}
+        self.max_examples = max_examples
+
+    def record(self, kind: str, row_num: int) -> None:
+        """Records `kind` for a single row."""
+        self.counts[kind] += 1
+        examples = self.first_rows.setdefault(kind, [])
+        if len(examples) < self.max_examples:
+            examples.append(row_num)
+
+    def add(self, kind: str, row_nums: Iterable[int]) -> None:
+        """Records `kind` for each row number in `row_nums`."""
+        row_nums = list(row_nums)
+        if not row_nums:
+            return
+        self.counts[kind] += len(row_nums)
+        examples = self.first_rows.setdefault(kind, [])
+        examples.extend(row_nums[:self.max_examples - len(examples)])
+
+    def log(self, descriptions: dict[str, str]) -> None:
+        """Logs one warning per recorded kind, using `descriptions[kind]` as its text."""
+        for kind, count in self.counts.items():
+            logger.warning(
+                "%d %s %s (first: %s).",
+                count, "row" if count == 1 else "rows", descriptions[kind],
+                ", ".join(f"row {n}" for n in self.first_rows[kind]),
+            )
+
+
+def _numeric_issue_descriptions(
+    dur_name: str | None, default_duration: float, inf_name: str | None, default_influence: float
+) -> dict[str, str]:
+    """Warning texts for the duration/influence problems tallied by iter_prompts*."""
+    return {
+        "duration_missing": f"lacked duration column '{dur_name}'; used global duration {default_duration}s",
+        "duration_invalid": f"had an invalid duration in CSV column '{dur_name}'; used global duration {default_duration}s",
+        "duration_out_of_range": f"had a duration out of range (0.5-22.0) in CSV column '{dur_name}'; used global duration {default_duration}s",
+        "influence_missing": f"lacked influence column '{inf_name}'; used global influence {default_influence}",
+        "influence_invalid": f"had an invalid influence in CSV column '{inf_name}'; used global influence {default_influence}",
+        "influence_out_of_range": f"had an influence out of range (0.0-1.0) in CSV column '{inf_name}'; used global influence {default_influence}",
+    }
+
+
+def iter_prompts(
+    reader: Iterator[list[str]],
+    header: list[str],
+    csv_name: str,
+    prompt_col_idx: int,
+    duration_col_idx: int,
+    influence_col_idx: int,
+    default_duration: float,
+    default_influence: float,
+) -> Iterator[dict]:
+    """
+    Lazily yields one validated prompt dict per usable CSV data row.
+
+    `reader` must already be positioned after the header row. Column indices of -1
+    mean "not used". Empty, malformed or prompt-less rows are skipped with a warning;
+    invalid, out-of-range or missing per-row durations/influences fall back to the
+    defaults and are reported as one aggregated warning per problem (count and first
+    row numbers) once `reader` is exhausted, rather than one log record per row.
+    Each yielded dict has the keys `text`, `row_num`, `duration` and `influence`.
+    """
+    prompt_name = header[prompt_col_idx]
+    dur_name = header[duration_col_idx] if duration_col_idx != -1 else None
+    inf_name = header[influence_col_idx] if influence_col_idx != -1 else None
+    issues = _RowIssues()
+
+    for i, row in enumerate(reader):
+        current_row_num = i + 2 # 1-based for header, 1-based for rows
+        if not row: # Skip empty rows
+            logger.warning("Skipping empty row %d in %s.", current_row_num, csv_name)
+            continue
+
+        row_len = len(row)
+        if prompt_col_idx >= row_len:
+            logger.warning(
+                "Skipping malformed row %d in %s (expected at least %d columns, found %d).",
+                current_row_num, csv_name, prompt_col_idx + 1, row_len,
+            )
+            continue
+
+        text_prompt = row[prompt_col_idx].strip('"')
+        if not text_prompt:
+            logger.warning("Skipping row %d due to empty prompt in column '%s'.", current_row_num, prompt_name)
+            continue
+
+        # Determine duration for this row
+        row_duration = default_duration # Start with global default
+        if dur_name is not None:
+            if duration_col_idx < row_len:
+                duration_str = row[duration_col_idx].strip()
+                if duration_str: # Only process if not empty
+                    try:
+                        val = float(duration_str)
+                    except ValueError:
+                        issues.record("duration_invalid", current_row_num)
+                    else:
+                        if 0.5 <= val <= 22.0:
+                            row_duration = val
+                            logger.debug("Row %d: Using duration from CSV: %ss", current_row_num, val)
+                        else:
+                            issues.record("duration_out_of_range", current_row_num)
+            else:
+                issues.record("duration_missing", current_row_num)
+
+        # Determine influence for this row
+        row_influence = default_influence # Start with global default
+        if inf_name is not None:
+            if influence_col_idx < row_len:
+                influence_str = row[influence_col_idx].strip()
+                if influence_str: # Only process if not empty
+                    try:
+                        val = float(influence_str)
+                    except ValueError:
+                        issues.record("influence_invalid", current_row_num)
+                    else:
+                        if 0.0 <= val <= 1.0:
+                            row_influence = val
+                            logger.debug("Row %d: Using influence from CSV: %s", current_row_num, val)
+                        else:
+                            issues.record("influence_out_of_range", current_row_num)
+            else:
+                issues.record("influence_missing", current_row_num)
+
+        yield {
+            "text": text_prompt,
+            "row_num": current_row_num,
+            "duration": row_duration,
+            "influence": row_influence,
+        }
+
+    issues.log(_numeric_issue_descriptions(dur_name, default_duration, inf_name, default_influence))
+
+
+def iter_prompts_vectorized(
+    reader: Iterator[list[str]],
+    header: list[str],
+    csv_name: str,
+    prompt_col_idx: int,
+    duration_col_idx: int,
+    influence_col_idx: int,
+    default_duration: float,
+    default_influence: float,
+    chunk_size: int = VALIDATION_CHUNK_ROWS,
+) -> Iterator[dict]:
+    """
+    Like iter_prompts, but validates durations and influences `chunk_size` rows at a time.
+
+    Each chunk's numeric column is parsed with pyarrow.compute and range-checked with
+    NumPy masks instead of calling float() and comparing per row. Fallbacks and the
+    aggregated warnings are the same as in iter_prompts.
+
+    Requires numpy and pyarrow (the 'arrow' extra).
+    """
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    prompt_name = header[prompt_col_idx]
+    dur_name = header[duration_col_idx] if duration_col_idx != -1 else None
+    inf_name = header[influence_col_idx] if influence_col_idx != -1 else None
+    issues = _RowIssues()
+
+    def resolve(values: list[str | None], row_nums: list[int], label: str, low: float, high: float, default: float) -> list[float]:
+        # values[i] is None when the row is too short to have the column
+        column = pc.utf8_trim_whitespace(pa.array(values, type=pa.string()))
+        missing = column.is_null().to_numpy(zero_copy_only=False)
+        empty = pc.equal(column, "").fill_null(False).to_numpy(zero_copy_only=False)
+        numeric = pc.match_substring_regex(column, _FLOAT_PATTERN).fill_null(False)
+        parsed = pc.cast(pc.if_else(numeric, column, None), pa.float64()).to_numpy(zero_copy_only=False)
+        numeric = numeric.to_numpy(zero_copy_only=False)
+        in_range = (parsed >= low) & (parsed <= high) # NaN (not numeric) compares False
+
+        rows = np.asarray(row_nums)
+        issues.add(f"{label}_missing", rows[missing].tolist())
+        issues.add(f"{label}_invalid", rows[~(missing | empty | numeric)].tolist())
+        issues.add(f"{label}_out_of_range", rows[numeric & ~in_range].tolist())
+        if logger.isEnabledFor(logging.DEBUG):
+            unit = "s" if label == "duration" else ""
+            for n, val in zip(rows[in_range].tolist(), parsed[in_range].tolist()):
+                logger.debug("Row %d: Using %s from CSV: %s%s", n, label, val, unit)
+        return np.where(in_range, parsed, default).tolist()
+
+    current_row_num = 1 # The header
+    while chunk := list(itertools.islice(reader, chunk_size)):
+        row_nums: list[int] = []
+        texts: list[str] = []
+        durations: list[str | None] = []
+        influences: list[str | None] = []
+        for row in chunk:
+            current_row_num += 1
+            if not row: # Skip empty rows
+                logger.warning("Skipping empty row %d in %s.", current_row_num, csv_name)
+                continue
+            row_len = len(row)
+            if prompt_col_idx >= row_len:
+                logger.warning(
+                    "Skipping malformed row %d in %s (expected at least %d columns, found %d).",
+                    current_row_num, csv_name, prompt_col_idx + 1, row_len,
+                )
+                continue
+            text_prompt = row[prompt_col_idx].strip('"')
+            if not text_prompt:
+                logger.warning("Skipping row %d due to empty prompt in column '%s'.", current_row_num, prompt_name)
+                continue
+            row_nums.append(current_row_num)
+            texts.append(text_prompt)
+            if dur_name is not None:
+                durations.append(row[duration_col_idx] if duration_col_idx < row_len else None)
+            if inf_name is not None:
+                influences.append(row[influence_col_idx] if influence_col_idx < row_len else None)
+
+        if dur_name is not None:
+            row_durations = resolve(durations, row_nums, "duration", 0.5, 22.0, default_duration)
+        else:
+            row_durations = [default_duration] * len(texts)
+        if inf_name is not None:
+            row_influences = resolve(influences, row_nums, "influence", 0.0, 1.0, default_influence)
+        else:
+            row_influences = [default_influence] * len(texts)
+
+        for text_prompt, row_num, row_duration, row_influence in zip(texts, row_nums, row_durations, row_influences):
+            yield {
+                "text": text_prompt,
+                "row_num": row_num,
+                "duration": row_duration,
+                "influence": row_influence,
+            }
+
+    issues.log(_numeric_issue_descriptions(dur_name, default_duration, inf_name, default_influence))
+
+
+async def _call_with_retry(
+    fn: Callable[[], Awaitable[T]],
+    *,
+    max_retries: int,
+    base: float = RETRY_BACKOFF_BASE,
+    cap: float = RETRY_BACKOFF_CAP,
+    description: str = "API call",
+) -> T:
+    """
+    Awaits `fn()`, retrying up to `max_retries` times on rate-limit and generation errors.
+
+    Between attempts it sleeps `min(cap, base * 2**attempt)` seconds plus random jitter
+    of up to `base` seconds, so concurrent workers don't retry in lockstep. For rate-limit
+    errors that expose a `Retry-After` delay, that delay (plus jitter) is used instead.
+    The last error is re-raised once retries are exhausted; other errors propagate immediately.
+    """
+    attempt = 0
+    while True:
+        try:
+            return await fn()
+        except (ElevenLabsRateLimitError, ElevenLabsGenerationError) as e:
+            if attempt >= max_retries:
+                raise
+            retry_after = get_retry_after(e) if isinstance(e, ElevenLabsRateLimitError) else None
+            if retry_after is not None:
+                delay = retry_after + random.uniform(0, base)
+            else:
+                delay = min(cap, base * 2 ** attempt) + random.uniform(0, base)
+            attempt += 1
+            logger.warning(
+                f"{type(e).__name__} for {description}; retrying in {delay:.1f}s "
+                f"(retry {attempt}/{max_retries})."
+            )
+            await asyncio.sleep(delay)
+
+
+async def _process_all(
+    prompts: Iterable[dict],
+    sfx_client: ElevenLabsSFXClient,
+    allocator: FilenameAllocator,
+    cache_dir: Path | None,
+    max_concurrency: int,
+    rate_limiters: list[TokenBucket],
+    max_retries: int,
+    debug: bool,
+    skip_existing: bool = False,
+) -> dict[str, int]:
+    """
+    Generates and saves sound effects for all prompts concurrently.
+
+    Prompts are pulled lazily from `prompts` by a producer task into a bounded queue
+    drained by worker tasks, so the full prompt list is never held in memory and the
+    first API call starts as soon as the first row is parsed. Each blocking
+    `generate_sound_effect` call runs in a worker thread, and at most `max_concurrency`
+    calls are in flight at once so that network latency overlaps across prompts.
+    Every call first acquires a token from each of `rate_limiters`. Rate-limit and
+    transient generation errors are retried with backoff (see `_call_with_retry`).
+
+    If `cache_dir` is given, audio previously generated for the same
+    (prompt, duration, influence) is copied from the cache instead of calling the API,
+    and newly generated audio is stored there for later runs. Rows repeating an earlier
+    (prompt, duration, influence) reuse its audio instead of making another request, but
+    still get their own output file. Finished audio is only kept in memory until it is
+    saved: later repeats are served from the cache or, without one, copied from the
+    first row's output file.
+
+    If `skip_existing` is set, prompts whose deterministic output file
+    (`sanitize_filename(text)` + ".mp3") was already in the output directory before the
+    run are skipped entirely, so an interrupted batch can be resumed by re-running it.
+    Only the prompt text is compared, so rows with an edited duration or influence are
+    skipped as well.
+
+    Output files are allocated and written by a single background writer thread fed
+    through a bounded `queue.Queue`, so workers move on to the next prompt as soon as its
+    audio is handed off, while only a few generated files wait in memory at a time.
+    `generated` counts the files the writer actually saved; the writer is drained and
+    joined before returning, even if processing is interrupted.
+
+    Returns a dict of counters: `prompts`, `generated`, `failed`, `skipped`, `cache_hits`,
+    `cache_misses` and `deduplicated`. Exceptions raised while reading `prompts`
+    propagate to the caller.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    stats = {
+        "prompts": 0, "generated": 0, "failed": 0, "skipped": 0,
+        "cache_hits": 0, "cache_misses": 0, "deduplicated": 0,
+    }
+    # One audio task per unique (text, duration, influence); duplicate rows await it.
+    audio_tasks: dict[tuple[str, float, float], asyncio.Task] = {}
+    # Without a cache, the first file saved for each key; its task is then dropped.
+    saved_outputs: dict[tuple[str, float, float], Path] = {}
+    loop = asyncio.get_running_loop()
+    # Extra workers beyond the API concurrency keep cache hits from waiting behind
+    # in-flight API calls; the queue bound provides backpressure.
+    num_workers = max_concurrency * 2
+    prompt_queue: asyncio.Queue = asyncio.Queue(maxsize=num_workers * 2)
+    # (base_filename, audio_bytes, dedupe_key) jobs for the writer thread; None shuts it down.
+    write_queue: queue.Queue = queue.Queue(maxsize=num_workers)
+    # Only touched by the writer thread until it has been joined.
+    write_stats = {"generated": 0, "failed": 0}
+
+    def writer() -> None:
+        while (job := write_queue.get()) is not None:
+            base_filename, audio_bytes, dedupe_key = job
+            try:
+                while True:
+                    output_file_path = allocator.allocate(base_filename, extension=".mp3")
+                    try:
+                        write_new_file(output_file_path, audio_bytes)
+                        break
+                    except FileExistsError: # Created by someone else since the directory snapshot
+                        logger.debug("%s already exists; allocating another filename.", output_file_path.name)
+            except OSError as e:
+                logger.error(f"Could not write {output_file_path}: {e}")
+                write_stats["failed"] += 1
+            except Exception as e: # Never let one bad job kill the writer and stall the queue
+                logger.error(f"An unexpected error occurred while saving {base_filename}.mp3: {e}")
+                if debug:
+                    logger.exception("Full traceback for unexpected error:")
+                write_stats["failed"] += 1
+            else:
+                if logger.isEnabledFor(logging.INFO): # resolve() costs syscalls; skip it when not logged
+                    logger.info("Saved: %s", output_file_path.resolve())
+                write_stats["generated"] += 1
+                if cache_dir is None and dedupe_key not in saved_outputs:
+                    # Recorded before the task is dropped, so a lookup never misses both
+                    saved_outputs[dedupe_key] = output_file_path
+                    loop.call_soon_threadsafe(audio_tasks.pop, dedupe_key, None)
+            # Release the audio now rather than while blocked waiting for the next job
+            del job, audio_bytes
+
+    def hand_to_writer(job: tuple[str, bytes, tuple[str, float, float]] | None) -> bool:
+        """Blocks until the writer accepts `job`; returns False if the writer thread has died."""
+        while writer_thread.is_alive():
+            try:
+                write_queue.put(job, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    async def generate(text_prompt: str, row_num: int, duration: float, influence: float) -> bytes:
+        async def attempt() -> bytes:
+            async with semaphore:
+                if logger.isEnabledFor(logging.INFO):
+                    log_prompt_snippet = f"'{text_prompt[:50]}{'...' if len(text_prompt) > 50 else ''}'"
+                    logger.info(
+                        "Processing prompt from CSV row %d: %s (Duration: %ss, Influence: %s)",
+                        row_num, log_prompt_snippet, duration, influence,
+                    )
+                for limiter in rate_limiters:
+                    await limiter.acquire()
+                return await asyncio.to_thread(
+                    sfx_client.generate_sound_effect,
+                    text=text_prompt,
+                    duration_seconds=duration,
+                    prompt_influence=influence,
+                )
+
+        # Backoff sleeps happen outside the semaphore, so other prompts can use the slot.
+        return await _call_with_retry(
+            attempt,
+            max_retries=max_retries,
+            base=RETRY_BACKOFF_BASE,
+            description=f"prompt from row {row_num}",
+        )
+
+    async def fetch_audio(text_prompt: str, row_num: int, duration: float, influence: float) -> bytes:
+        cache_path = None
+        if cache_dir is not None:
+            cache_key = get_cache_key(text_prompt, duration, influence)
+            cache_path = cache_dir / f"{cache_key}.mp3"
+
+        if cache_path is not None and cache_path.exists():
+            stats["cache_hits"] += 1
+            logger.info("Cache hit for prompt from CSV row %d; skipping API call.", row_num)
+            return await asyncio.to_thread(cache_path.read_bytes)
+
+        # audio_bytes should now be real audio data from the actual elevenlabs-sfx library.
+        audio_bytes = await generate(text_prompt, row_num, duration, influence)
+        if cache_path is not None:
+            stats["cache_misses"] += 1
+            try:
+                await asyncio.to_thread(store_cache_entry, cache_path, audio_bytes)
+            except OSError as e:
+                logger.warning(f"Could not write cache entry {cache_path}: {e}")
+        return audio_bytes
+
+    async def process_one(item: dict) -> str | None:
+        text_prompt = item["text"]
+        row_num = item["row_num"]
+        current_duration = item["duration"]
+        current_influence = item["influence"]
+
+        try:
+            base_filename = sanitize_filename(text_prompt)
+            if skip_existing and allocator.existed(f"{base_filename}.mp3"):
+                logger.info("Skipping prompt from CSV row %d: %s.mp3 already exists (cached on disk).", row_num, base_filename)
+                return "skipped"
+
+            dedupe_key = (text_prompt, round(current_duration, 3), round(current_influence, 3))
+            audio_task = audio_tasks.get(dedupe_key)
+            saved_path = saved_outputs.get(dedupe_key)
+            if audio_task is None and saved_path is None:
+                audio_task = asyncio.ensure_future(
+                    fetch_audio(text_prompt, row_num, current_duration, current_influence)
+                )
+                audio_tasks[dedupe_key] = audio_task
+                if cache_dir is not None:
+                    audio_task.add_done_callback(lambda _, key=dedupe_key: audio_tasks.pop(key, None))
+            else:
+                stats["deduplicated"] += 1
+                logger.info("Prompt from CSV row %d duplicates an earlier row; reusing its audio.", row_num)
+            if audio_task is None: # Already saved; copy the first row's file
+                audio_bytes = await asyncio.to_thread(saved_path.read_bytes)
+            else:
+                audio_bytes = await audio_task
+            job = (base_filename, audio_bytes, dedupe_key)
+            try:
+                write_queue.put_nowait(job)
+            except queue.Full: # Writer is behind; wait without blocking the event loop
+                if not await asyncio.to_thread(hand_to_writer, job):
+                    raise RuntimeError("the output writer thread stopped unexpectedly")
+            return None
+
+        # Catching specific exceptions from the elevenlabs_sfx library
+        except ElevenLabsAPIKeyError as e: # Uses the direct import
+            logger.error(f"API Key Error during generation for prompt from row {row_num} ('{text_prompt}'): {e}")
+        except ElevenLabsRateLimitError as e: # Uses the direct import
+            logger.error(f"Rate Limit Error for prompt from row {row_num} ('{text_prompt}'): {e}. Try again later or reduce batch size.")
+        except ElevenLabsParameterError as e: # Uses the direct import
+            logger.error(f"Parameter Error for prompt from row {row_num} ('{text_prompt}'): {e}")
+        except ElevenLabsGenerationError as e: # Uses the direct import
+            logger.error(f"Generation Error for prompt from row {row_num} ('{text_prompt}'): {e}")
+        # Note: ElevenLabsPermissionError and ElevenLabsAPIError from the sfx library
+        # would currently be caught by the generic Exception handler below if not listed explicitly.
+        # This matches the original sfx-batch spec's error handling detail.
+        except Exception as e: # Catch any other unexpected errors
+            logger.error(f"An unexpected error occurred while processing prompt from row {row_num} ('{text_prompt}'): {e}")
+            if debug:
+                logger.exception("Full traceback for unexpected error:")
+        return "failed"
+
+    async def worker() -> None:
+        while (item := await prompt_queue.get()) is not None:
+            if (outcome := await process_one(item)) is not None:
+                stats[outcome] += 1
+
+    writer_thread = threading.Thread(target=writer, name="sfx-batch-writer", daemon=True)
+    writer_thread.start()
+    workers = [asyncio.create_task(worker()) for _ in range(num_workers)]
+    try:
+        for item in prompts:
+            await prompt_queue.put(item)
+            stats["prompts"] += 1
+        if stats["prompts"]:
+            logger.info(f"Found {stats['prompts']} prompts to process.")
+        for _ in workers:
+            await prompt_queue.put(None) # Sentinel: no more prompts
+        await asyncio.gather(*workers)
+    except BaseException:
+        for task in [*workers, *audio_tasks.values()]:
+            task.cancel()
+        await asyncio.gather(*workers, *audio_tasks.values(), return_exceptions=True)
+        raise
+    finally:
+        # Let the writer save everything already generated before returning. The event
+        # loop never blocks on the queue, and a dead writer can't hang shutdown.
+        try:
+            write_queue.put_nowait(None)
+        except queue.Full:
+            await asyncio.to_thread(hand_to_writer, None)
+        await asyncio.to_thread(writer_thread.join)
+        stats["generated"] += write_stats["generated"]
+        stats["failed"] += write_stats["failed"]
+        # Jobs a dead writer never picked up were not saved
+        while True:
+            try:
+                stats["failed"] += write_queue.get_nowait() is not None
+            except queue.Empty:
+                break
+    return stats
+
+
 @app.command()
-def main(
+def run_batch(
     csv_file: Annotated[
         Path,
         typer.Argument(
@@ -136,6 +703,27 @@ def main(
             resolve_path=True,
         ),
     ] = Path("./sfx_output/"),
+    cache_dir: Annotated[
+        Path,
+        typer.Option(
+            "--cache-dir",
+            help="Directory for the persistent cache of generated audio. Identical (prompt, duration, influence) requests are served from here instead of the API.",
+            envvar="SFX_BATCH_CACHE_DIR",
+            file_okay=False,
+            dir_okay=True,
+        ),
+    ] = Path("~/.cache/sfx-batch/"),
+    no_cache: Annotated[
+        bool,
+        typer.Option("--no-cache", help="Disable the persistent audio cache."),
+    ] = False,
+    skip_existing: Annotated[
+        bool,
+        typer.Option(
+            "--skip-existing/--no-skip-existing",
+            help="Skip prompts whose output file (<sanitized_prompt>.mp3) already exists in the output directory, so interrupted batches can be resumed. Only the prompt text is compared; edited durations or influences are ignored.",
+        ),
+    ] = True,
     duration: Annotated[
         float,
         typer.Option(
@@ -166,6 +754,51 @@ def main(
             help="Maximum number of retry attempts for API calls (0-10).",
         ),
     ] = 3,
+    max_concurrency: Annotated[
+        int,
+        typer.Option(
+            "--max-concurrency",
+            "-c",
+            min=1,
+            max=32,
+            help="Maximum number of sound effects generated concurrently (1-32).",
+        ),
+    ] = 5,
+    rps: Annotated[
+        float | None,
+        typer.Option(
+            "--rps",
+            min=0.01,
+            help="Optional: Maximum API requests per second. Calls are paced to stay under this rate.",
+            show_default=False,
+        ),
+    ] = None,
+    rpm: Annotated[
+        float | None,
+        typer.Option(
+            "--rpm",
+            min=0.01,
+            help="Optional: Maximum API requests per minute. Calls are paced to stay under this rate.",
+            show_default=False,
+        ),
+    ] = None,
+    read_buffer_size: Annotated[
+        int,
+        typer.Option(
+            "--read-buffer-size",
+            min=1,
+            help="Read buffer size in bytes for the input CSV file (tuning/debug option).",
+            hidden=True,
+        ),
+    ] = DEFAULT_READ_BUFFER_SIZE,
+    csv_engine: Annotated[
+        CSVEngine,
+        typer.Option(
+            "--csv-engine",
+            help="CSV parser to use. 'pyarrow' parses large files with Arrow's multithreaded reader (requires the 'arrow' extra).",
+            case_sensitive=False,
+        ),
+    ] = CSVEngine.python,
     verbose: Annotated[
         bool,
         typer.Option("--verbose", "-v", help="Enable verbose logging for progress and detailed information."),
@@ -178,9 +811,9 @@ def main(
     """
     Generates sound effects in batch from a CSV file using elevenlabs-sfx.
     """
-    # Load environment variables from .env file if it exists
+    # Load environment variables from a .env file in (or above) the working directory.
     # This will not override existing environment variables by default.
-    if load_dotenv():
+    if load_dotenv(find_dotenv(usecwd=True)):
         logger.debug(".env file loaded.")
     else:
         logger.debug("No .env file found or it is empty.")
@@ -201,9 +834,28 @@ def main(
         logger.error(f"Could not create output directory {output_dir}: {e}")
         raise typer.Exit(code=1)
 
+    # Snapshot existing output files once; names are then reserved in memory, so the
+    # only filesystem call per saved file is the final O_EXCL open.
+    with os.scandir(output_dir) as entries:
+        existing_names = {entry.name for entry in entries}
+    logger.debug(f"Output directory already contains {len(existing_names)} entries.")
+    allocator = FilenameAllocator(output_dir, existing_names)
+
+    resolved_cache_dir = None
+    if not no_cache:
+        try:
+            resolved_cache_dir = cache_dir.expanduser()
+            resolved_cache_dir.mkdir(parents=True, exist_ok=True)
+            logger.info(f"Cache directory: {resolved_cache_dir.resolve()}")
+        except OSError as e:
+            logger.warning(f"Could not create cache directory {cache_dir}: {e}. Continuing without cache.")
+            resolved_cache_dir = None
+
     # --- Log parameters ---
     logger.info(f"Prompt column specified: {prompt_column}")
     logger.info(f"CSV Delimiter: '{delimiter}'")
+    logger.debug(f"CSV read buffer size: {read_buffer_size} bytes")
+    logger.debug(f"CSV engine: {csv_engine.value}")
     if duration_column:
         logger.info(f"Duration column specified: {duration_column} (Global --duration: {duration}s will be fallback)")
     else:
@@ -213,10 +865,18 @@ def main(
     else:
         logger.info(f"Global prompt influence: {prompt_influence} (no per-prompt influence column)")
     logger.info(f"Max retries for API calls: {max_retries}")
+    logger.info(f"Max concurrent API requests: {max_concurrency}")
+    if skip_existing:
+        logger.info("Skipping prompts whose output file already exists.")
+    if rps:
+        logger.info(f"Rate limit: {rps} requests/second")
+    if rpm:
+        logger.info(f"Rate limit: {rpm} requests/minute")
 
-    # Initialize the actual SFX client
+    # Initialize the actual SFX client. Retries are handled by _call_with_retry, so the
+    # client must not retry as well or the budgets would multiply.
     try:
-        sfx_client = ElevenLabsSFXClient(api_key=resolved_api_key, max_retries=max_retries)
+        sfx_client = ElevenLabsSFXClient(api_key=resolved_api_key, max_retries=0)
     except ElevenLabsAPIKeyError as e: # Uses the direct import
         logger.error(f"API Key Error: {e}")
         raise typer.Exit(code=1)
@@ -231,14 +891,28 @@ def main(
             logger.exception("Full traceback for SFXClient initialization error:")
         raise typer.Exit(code=1)
     
-    generated_count = 0
-    failed_count = 0
-    
-    prompts_data = []
+    rate_limiters = []
+    if rps:
+        rate_limiters.append(TokenBucket(rps, period=1.0))
+    if rpm:
+        rate_limiters.append(TokenBucket(rpm, period=60.0))
+
     try:
         # Use 'utf-8-sig' to handle CSVs with BOM
-        with open(csv_file, mode='r', encoding='utf-8-sig', newline='') as file:
-            reader = csv.reader(file, delimiter=delimiter) # Use specified delimiter
+        with contextlib.ExitStack() as stack:
+            if csv_engine is CSVEngine.pyarrow:
+                if not all(importlib.util.find_spec(name) for name in ("pyarrow", "numpy")):
+                    logger.error("The pyarrow CSV engine requires the 'pyarrow' and 'numpy' packages. Install them with: pip install 'sfx-batch[arrow]'")
+                    raise typer.Exit(code=1)
+                reader = stack.enter_context(contextlib.closing(
+                    iter_arrow_csv_rows(csv_file, delimiter, block_size=read_buffer_size)
+                ))
+            else:
+                file = stack.enter_context(
+                    open(csv_file, mode='r', encoding='utf-8-sig', newline='', buffering=read_buffer_size)
+                )
+                # Use specified delimiter; quote-free lines take a fast str.split path
+                reader = iter_csv_rows(file, delimiter)
             header = next(reader, None) # Skip header row
             if not header:
                 logger.error(f"CSV file '{csv_file.name}' is empty or has no header.")
@@ -309,79 +983,35 @@ def main(
                     except ValueError:
                         logger.warning(f"Influence column name '{influence_column}' not found in CSV header. Will use global --prompt-influence.")
 
-            for i, row in enumerate(reader):
-                current_row_num = i + 2 # 1-based for header, 1-based for rows
-                if not row: # Skip empty rows
-                    logger.warning(f"Skipping empty row {current_row_num} in {csv_file.name}.")
-                    continue
-                
-                try:
-                    text_prompt_raw = row[prompt_col_idx]
-                    text_prompt = text_prompt_raw.strip('"')
-
-                    if not text_prompt:
-                        logger.warning(f"Skipping row {current_row_num} due to empty prompt in column '{header[prompt_col_idx]}'.")
-                        continue
-
-                    # Determine duration for this row
-                    row_duration = duration # Start with global default
-                    if duration_col_idx != -1:
-                        try:
-                            duration_str = row[duration_col_idx].strip()
-                            if duration_str: # Only process if not empty
-                                val = float(duration_str)
-                                if 0.5 <= val <= 22.0:
-                                    row_duration = val
-                                    logger.debug(f"Row {current_row_num}: Using duration from CSV: {val}s")
-                                else:
-                                    logger.warning(
-                                        f"Row {current_row_num}: Duration '{val}' from CSV column '{header[duration_col_idx]}' is out of range (0.5-22.0). "
-                                        f"Using global duration: {duration}s."
-                                    )
-                        except IndexError:
-                            logger.warning(f"Row {current_row_num}: Duration column '{header[duration_col_idx]}' missing. Using global duration: {duration}s.")
-                        except ValueError:
-                            logger.warning(
-                                f"Row {current_row_num}: Invalid duration value '{row[duration_col_idx]}' in CSV column '{header[duration_col_idx]}'. "
-                                f"Using global duration: {duration}s."
-                            )
-                    
-                    # Determine influence for this row
-                    row_influence = prompt_influence # Start with global default
-                    if influence_col_idx != -1:
-                        try:
-                            influence_str = row[influence_col_idx].strip()
-                            if influence_str: # Only process if not empty
-                                val = float(influence_str)
-                                if 0.0 <= val <= 1.0:
-                                    row_influence = val
-                                    logger.debug(f"Row {current_row_num}: Using influence from CSV: {val}")
-                                else:
-                                    logger.warning(
-                                        f"Row {current_row_num}: Influence '{val}' from CSV column '{header[influence_col_idx]}' is out of range (0.0-1.0). "
-                                        f"Using global influence: {prompt_influence}."
-                                    )
-                        except IndexError:
-                            logger.warning(f"Row {current_row_num}: Influence column '{header[influence_col_idx]}' missing. Using global influence: {prompt_influence}.")
-                        except ValueError:
-                            logger.warning(
-                                f"Row {current_row_num}: Invalid influence value '{row[influence_col_idx]}' in CSV column '{header[influence_col_idx]}'. "
-                                f"Using global influence: {prompt_influence}."
-                            )
-                    
-                    prompts_data.append({
-                        "text": text_prompt, 
-                        "row_num": current_row_num,
-                        "duration": row_duration,
-                        "influence": row_influence
-                    })
-
-                except IndexError:
-                    logger.warning(
-                        f"Skipping malformed row {i+2} in {csv_file.name} (expected at least {prompt_col_idx + 1} columns, found {len(row)})."
-                    )
-                    continue
+            # Rows are parsed lazily and fed to the workers while the file stays open.
+            # The pyarrow engine also validates numeric columns in vectorized chunks.
+            iter_valid_prompts = iter_prompts_vectorized if csv_engine is CSVEngine.pyarrow else iter_prompts
+            prompts = iter_valid_prompts(
+                reader,
+                header,
+                csv_file.name,
+                prompt_col_idx,
+                duration_col_idx,
+                influence_col_idx,
+                duration,
+                prompt_influence,
+            )
+            stats = asyncio.run(
+                _process_all(
+                    prompts,
+                    sfx_client,
+                    allocator,
+                    resolved_cache_dir,
+                    max_concurrency,
+                    rate_limiters,
+                    max_retries,
+                    debug,
+                    skip_existing,
+                )
+            )
     
+    except typer.Exit:
+        raise
     except FileNotFoundError: # Should be caught by Typer, but good practice
         logger.error(f"Input CSV file not found: {csv_file}")
         raise typer.Exit(code=1)
@@ -391,65 +1021,19 @@ def main(
             logger.exception("Full traceback for CSV processing error:")
         raise typer.Exit(code=1)
 
-    if not prompts_data:
+    if not stats["prompts"]:
         logger.info("No valid prompts found in the CSV file.")
         raise typer.Exit(code=0)
 
-    logger.info(f"Found {len(prompts_data)} prompts to process.")
-
-    for item in prompts_data:
-        text_prompt = item["text"]
-        row_num = item["row_num"]
-        current_duration = item["duration"]
-        current_influence = item["influence"]
-        
-        log_prompt_snippet = f"'{text_prompt[:50]}{'...' if len(text_prompt) > 50 else ''}'"
-        logger.info(
-            f"Processing prompt from CSV row {row_num}: {log_prompt_snippet} "
-            f"(Duration: {current_duration}s, Influence: {current_influence})"
-        )
-        
-        try:
-            audio_bytes = sfx_client.generate_sound_effect(
-                text=text_prompt,
-                duration_seconds=current_duration,
-                prompt_influence=current_influence
-            )
-            
-            base_filename = sanitize_filename(text_prompt)
-            output_file_path = get_unique_filepath(output_dir, base_filename, extension=".mp3")
-
-            with open(output_file_path, "wb") as f:
-                # audio_bytes should now be real audio data from the actual elevenlabs-sfx library.
-                f.write(audio_bytes)
-                logger.info(f"Saved: {output_file_path.resolve()}")
-                generated_count += 1
-
-        # Catching specific exceptions from the elevenlabs_sfx library
-        except ElevenLabsAPIKeyError as e: # Uses the direct import
-            logger.error(f"API Key Error during generation for prompt from row {row_num} ('{text_prompt}'): {e}")
-            failed_count +=1
-        except ElevenLabsRateLimitError as e: # Uses the direct import
-            logger.error(f"Rate Limit Error for prompt from row {row_num} ('{text_prompt}'): {e}. Try again later or reduce batch size.")
-            failed_count +=1
-        except ElevenLabsParameterError as e: # Uses the direct import
-            logger.error(f"Parameter Error for prompt from row {row_num} ('{text_prompt}'): {e}")
-            failed_count +=1
-        except ElevenLabsGenerationError as e: # Uses the direct import
-            logger.error(f"Generation Error for prompt from row {row_num} ('{text_prompt}'): {e}")
-            failed_count +=1
-        # Note: ElevenLabsPermissionError and ElevenLabsAPIError from the sfx library
-        # would currently be caught by the generic Exception handler below if not listed explicitly.
-        # This matches the original sfx-batch spec's error handling detail.
-        except Exception as e: # Catch any other unexpected errors
-            logger.error(f"An unexpected error occurred while processing prompt from row {row_num} ('{text_prompt}'): {e}")
-            failed_count +=1
-            if debug:
-                logger.exception("Full traceback for unexpected error:")
-
     logger.info("--- Batch Processing Summary ---")
-    logger.info(f"Successfully generated {generated_count} sound effects.")
-    logger.info(f"Failed to generate {failed_count} sound effects.")
+    logger.info(f"Successfully generated {stats['generated']} sound effects.")
+    logger.info(f"Failed to generate {stats['failed']} sound effects.")
+    if stats["skipped"]:
+        logger.info(f"Skipped {stats['skipped']} prompts whose output file already existed.")
+    if stats["deduplicated"]:
+        logger.info(f"Reused audio for {stats['deduplicated']} duplicate prompts instead of requesting it again.")
+    if resolved_cache_dir is not None:
+        logger.info(f"Cache hits: {stats['cache_hits']}, cache misses: {stats['cache_misses']}.")
     logger.info("sfx-batch processing finished.")
 
 
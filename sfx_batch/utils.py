@@ -1,10 +1,62 @@
 import re
 import os
+import csv
+import functools
+import itertools
 from pathlib import Path
+from typing import Container, Iterable, Iterator, TextIO
 import logging
+import asyncio
+import hashlib
+import time
+import uuid
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
 
 logger = logging.getLogger(__name__)
 
+# Highest numeric suffix tried for a colliding filename before falling back to a random one.
+MAX_FILENAME_COLLISIONS = 1000
+
+# Patterns used by sanitize_filename, compiled once at import time.
+# Spaces and problematic characters: / \ : * ? " < > |
+_BAD_CHARS = re.compile(r'[\\/:*?"<>| ]')
+# Anything that is not alphanumeric, an underscore or a period
+_STRIP_NONWORD = re.compile(r'[^\w.]')
+_DEDUPE_UNDERSCORE = re.compile(r'_{2,}')
+
+# Byte-level equivalent of the three passes above for ASCII-only prompts: one
+# bytes.translate() call maps bad characters to "_", lowercases letters and deletes
+# everything else that is not alphanumeric, "_" or ".".
+_ASCII_KEEP = b"abcdefghijklmnopqrstuvwxyz0123456789_."
+_ASCII_SANITIZE_TABLE = bytes(
+    ord("_") if chr(b) in '\\/:*?"<>| ' else ord(chr(b).lower())
+    for b in range(256)
+)
+_ASCII_SANITIZE_DELETE = bytes(
+    b for b in range(128)
+    if chr(b) not in '\\/:*?"<>| ' and ord(chr(b).lower()) not in _ASCII_KEEP
+)
+
+
+def _replace_chars_ascii(text: str) -> str:
+    """Replaces/strips characters and lowercases an ASCII-only `text` in one translate pass."""
+    return text.encode("ascii").translate(_ASCII_SANITIZE_TABLE, _ASCII_SANITIZE_DELETE).decode("ascii")
+
+
+def _replace_chars_unicode(text: str) -> str:
+    """Replaces/strips characters and lowercases `text` using the Unicode-aware patterns."""
+    # Replace spaces and problematic characters with underscores (single pass)
+    sanitized = _BAD_CHARS.sub("_", text)
+    # Convert to lowercase before stripping: lower() can emit non-word characters
+    # (e.g. "İ" -> "i" + U+0307 combining dot), which would otherwise survive one pass
+    sanitized = sanitized.lower()
+    # Remove any remaining non-alphanumeric characters (except underscores and periods)
+    # \w matches alphanumeric characters and underscore. We also want to keep periods.
+    return _STRIP_NONWORD.sub("", sanitized)
+
+
+@functools.lru_cache(maxsize=1024)
 def sanitize_filename(prompt_text: str, max_length: int = 150) -> str:
     """
     Sanitizes a text prompt to create a valid, filesystem-safe filename.
@@ -12,27 +64,27 @@ def sanitize_filename(prompt_text: str, max_length: int = 150) -> str:
     - Removes any remaining non-alphanumeric characters (except underscores and periods).
     - Converts to lowercase.
     - Truncates to a maximum length (before adding .mp3 and collision suffix).
+
+    Results are memoized, since batches often repeat a prompt (e.g. with different
+    durations).
     """
     if not prompt_text:
         return "unnamed_sfx"
 
-    # Replace spaces and problematic characters with underscores
-    # Problematic characters: / \ : * ? " < > |
-    no_spaces = prompt_text.replace(" ", "_")
-    sanitized = re.sub(r'[\\/:*?"<>|]', "_", no_spaces)
-
-    # Remove any remaining non-alphanumeric characters (except underscores and periods)
-    # \w matches alphanumeric characters and underscore. We also want to keep periods.
-    sanitized = re.sub(r'[^\w._]', "", sanitized)
-    
-    # Convert to lowercase
-    sanitized = sanitized.lower()
+    # Replace problematic characters, drop other non-word characters and lowercase.
+    # Plain-ASCII prompts (the common case) take the single-pass bytes fast path.
+    if prompt_text.isascii():
+        sanitized = _replace_chars_ascii(prompt_text)
+    else:
+        sanitized = _replace_chars_unicode(prompt_text)
 
     # Remove leading/trailing underscores or periods that might have resulted
     sanitized = sanitized.strip('_.-')
     
     # Replace multiple consecutive underscores with a single underscore
-    sanitized = re.sub(r'_{2,}', '_', sanitized)
+    # (most names have none, and the substring test is far cheaper than a regex pass)
+    if '__' in sanitized:
+        sanitized = _DEDUPE_UNDERSCORE.sub('_', sanitized)
     
     # If after sanitization the string is empty (e.g., prompt was only "???"), provide a default
     if not sanitized:
@@ -51,26 +103,303 @@ def sanitize_filename(prompt_text: str, max_length: int = 150) -> str:
     return sanitized
 
 
-def get_unique_filepath(output_dir: Path, base_filename: str, extension: str = ".mp3") -> Path:
+def _first_free_suffix(base_filename: str, extension: str, taken: Container[str], start: int = 1) -> int | None:
+    """
+    Returns a suffix n >= `start` for which `{base_filename}_{n}{extension}` is not in
+    `taken`, or None past MAX_FILENAME_COLLISIONS. Suffix `start - 1` (0 stands for the bare name)
+    must be taken. Suffixes are probed exponentially and the gap after the last taken
+    one is bisected; assuming they were handed out sequentially, this is the first free
+    one, and it is free in any case.
+    """
+    def candidate(counter: int) -> str:
+        return f"{base_filename}_{counter}{extension}"
+
+    if start > MAX_FILENAME_COLLISIONS:
+        return None
+    # low: largest suffix known to be taken; high: next to probe
+    low, high, step = start - 1, start, 1
+    while candidate(high) in taken:
+        if high >= MAX_FILENAME_COLLISIONS:
+            return None
+        low, high, step = high, min(high + step, MAX_FILENAME_COLLISIONS), step * 2
+
+    # candidate(low) is taken and candidate(high) is free; narrow down to adjacent suffixes
+    while high - low > 1:
+        middle = (low + high) // 2
+        if candidate(middle) in taken:
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+def _collision_fallback(base_filename: str, extension: str) -> str:
+    """Returns a random filename for when a base name has run out of numeric suffixes."""
+    logger.warning(f"More than {MAX_FILENAME_COLLISIONS} filename collisions for {base_filename}. Check output directory.")
+    return f"{base_filename}_{uuid.uuid4().hex[:8]}{extension}"
+
+
+def get_unique_filepath(
+    output_dir: Path,
+    base_filename: str,
+    extension: str = ".mp3",
+    *,
+    existing_names: Iterable[str] | None = None,
+) -> Path:
     """
     Generates a unique filepath by appending a sequential number if a file with
     the target name already exists.
     e.g., sound.mp3, sound_1.mp3, sound_2.mp3
+
+    Candidates are checked against a snapshot of the directory's names, so collisions
+    cost no stat() calls. `existing_names` is that snapshot; if omitted, it is read with
+    a single os.scandir() call. Suffixes are probed exponentially (_1, _2, _4, ...) and
+    the gap after the last taken one is bisected (see `_first_free_suffix`).
     """
+    if existing_names is None:
+        try:
+            with os.scandir(output_dir) as entries:
+                existing_names = [entry.name for entry in entries]
+        except FileNotFoundError: # Nothing can collide in a directory that doesn't exist yet
+            existing_names = []
+    taken = {name for name in existing_names if name.endswith(extension)}
+
     output_filename = f"{base_filename}{extension}"
-    output_file_path = output_dir / output_filename
-    
-    counter = 1
-    while output_file_path.exists():
-        output_filename = f"{base_filename}_{counter}{extension}"
-        output_file_path = output_dir / output_filename
-        counter += 1
-        if counter > 1000: # Safety break for extreme cases
-            logger.warning(f"More than 1000 filename collisions for {base_filename}. Check output directory.")
-            # Fallback to a more unique name if something is very wrong
-            import uuid
-            output_filename = f"{base_filename}_{uuid.uuid4().hex[:8]}{extension}"
-            output_file_path = output_dir / output_filename
-            break 
-            
-    return output_file_path
+    if output_filename not in taken:
+        return output_dir / output_filename
+
+    counter = _first_free_suffix(base_filename, extension, taken)
+    if counter is None: # Safety break for extreme cases
+        return output_dir / _collision_fallback(base_filename, extension)
+    return output_dir / f"{base_filename}_{counter}{extension}"
+
+
+def write_new_file(path: Path, data: bytes) -> None:
+    """
+    Writes `data` to a file that must not exist yet, raising FileExistsError otherwise.
+    Uses a raw `os.open(..., O_EXCL)` descriptor: the existence check and creation are
+    a single atomic syscall, and the one-shot write bypasses Python's buffered IO layer.
+    No flush/fsync is issued; durability is left to the OS.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+    finally:
+        os.close(fd)
+
+
+class FilenameAllocator:
+    """
+    Allocates unique output filepaths in a directory without a stat() per candidate.
+
+    The directory listing is read once on construction and chosen names are reserved
+    in memory, so allocation needs no syscalls and two allocations never return the
+    same path. A per-name counter remembers the next suffix to try, so repeated
+    collisions on one base name don't rescan from `_1`. Suffixes are found with the
+    same probe as get_unique_filepath (sound.mp3, sound_1.mp3, sound_2.mp3, ...),
+    including its random fallback past MAX_FILENAME_COLLISIONS.
+
+    `existing_names` is the snapshot of names already in `output_dir`; if omitted, it is
+    read with a single os.scandir() call.
+    """
+
+    def __init__(self, output_dir: Path, existing_names: Iterable[str] | None = None):
+        self.output_dir = output_dir
+        if existing_names is None:
+            with os.scandir(output_dir) as entries:
+                existing_names = [entry.name for entry in entries]
+        self._existing = frozenset(existing_names)
+        self._taken = set(self._existing)
+        self._next_suffix: dict[str, int] = {}
+
+    def existed(self, filename: str) -> bool:
+        """Returns True if `filename` was already in the directory when the allocator was created."""
+        return filename in self._existing
+
+    def allocate(self, base_filename: str, extension: str = ".mp3") -> Path:
+        """Reserves and returns a filepath for `base_filename` that is not yet taken."""
+        output_filename = f"{base_filename}{extension}"
+        if output_filename in self._taken:
+            start = self._next_suffix.get(output_filename, 1)
+            counter = _first_free_suffix(base_filename, extension, self._taken, start)
+            if counter is None:
+                output_filename = _collision_fallback(base_filename, extension)
+            else:
+                self._next_suffix[output_filename] = counter + 1
+                output_filename = f"{base_filename}_{counter}{extension}"
+        self._taken.add(output_filename)
+        return self.output_dir / output_filename
+
+
+class TokenBucket:
+    """
+    Asynchronous token-bucket rate limiter.
+
+    Tokens refill continuously at `rate` tokens per `period` seconds, up to `capacity`
+    (defaults to 1, so calls are evenly paced and any window of one `period` holds at
+    most `rate + 1` of them). Each `acquire()` consumes one token, sleeping until one
+    is available.
+    """
+
+    def __init__(self, rate: float, period: float = 1.0, capacity: float | None = None):
+        if rate <= 0 or period <= 0:
+            raise ValueError("rate and period must be positive.")
+        self.refill_per_second = rate / period
+        self.capacity = capacity if capacity is not None else 1.0
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.refill_per_second)
+        self._last_refill = now
+
+    async def acquire(self) -> None:
+        """Waits until a token is available, then consumes it."""
+        async with self._lock: # Waiters are served in FIFO order
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.refill_per_second)
+                self._refill()
+                # The sleep covered the deficit; float rounding must not cause extra sleeps
+                self._tokens = max(self._tokens, 1.0)
+            self._tokens -= 1
+
+
+def get_retry_after(error: Exception) -> float | None:
+    """
+    Extracts a `Retry-After` delay (in seconds) from a rate-limit exception, if exposed.
+    Looks for a `retry_after` attribute first, then a `Retry-After` header on an attached
+    `response`. Both delta-seconds and HTTP-date header values are supported.
+    """
+    value = getattr(error, "retry_after", None)
+    if value is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+        if headers is not None:
+            value = headers.get("Retry-After")
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        retry_at = parsedate_to_datetime(str(value))
+    except (TypeError, ValueError):
+        logger.debug(f"Could not parse Retry-After value: {value!r}")
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def get_cache_key(text: str, duration: float, influence: float) -> str:
+    """
+    Returns a stable, content-addressed cache key for a generation request.
+    The key is a hex BLAKE2b digest of the prompt text, duration and influence.
+    """
+    return hashlib.blake2b(f"{text}|{duration}|{influence}".encode("utf-8"), digest_size=16).hexdigest()
+
+
+def store_cache_entry(cache_path: Path, data: bytes) -> None:
+    """
+    Atomically writes `data` to `cache_path`.
+    The bytes are written to a temporary file in the same directory and then renamed
+    into place, so concurrent runs never observe a partially written cache entry.
+    """
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def iter_csv_rows(file: TextIO, delimiter: str) -> Iterator[list[str]]:
+    """
+    Yields the rows of a CSV file, equivalent to `csv.reader(file, delimiter=delimiter)`.
+
+    Lines without double quotes are split with `str.split`, which is several times
+    faster than the csv module. As soon as a line contains a quote character, that
+    line and the rest of the file are handed to `csv.reader`, so quoted fields
+    (including ones spanning multiple lines) are parsed exactly as before.
+    `file` should be opened with `newline=''`, as for `csv.reader`.
+    """
+    if len(delimiter) != 1 or delimiter in '"\r\n':
+        yield from csv.reader(file, delimiter=delimiter)
+        return
+
+    for line in file:
+        if '"' in line:
+            yield from csv.reader(itertools.chain([line], file), delimiter=delimiter)
+            return
+        line = line.rstrip("\r\n")
+        yield line.split(delimiter) if line else []
+
+
+def iter_arrow_csv_rows(path: Path, delimiter: str, block_size: int = 1 << 20) -> Iterator[list[str]]:
+    """
+    Yields the rows of the CSV file at `path` like iter_csv_rows, parsed with pyarrow.
+
+    Tokenizing and UTF-8 decoding run in Arrow's multithreaded C++ streaming reader,
+    one `block_size` block at a time, so memory stays bounded for large files. Every
+    column is read as a string, so values reach the caller exactly as written. Rows
+    whose field count differs from the header are re-parsed with the csv module and
+    yielded in their original position, keeping row numbers in line with csv.reader
+    (assuming no quoted field spans several lines). Rows whose fields are all empty
+    are yielded as `[]`, like csv.reader does for blank lines.
+
+    Raises ImportError immediately (not on first iteration) if pyarrow is not installed.
+    """
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+
+    def rows() -> Iterator[list[str]]:
+        with open(path, mode='r', encoding='utf-8-sig', newline='') as file:
+            header = next(csv.reader(file, delimiter=delimiter), None)
+        if header is None:
+            return
+        yield header
+
+        # Physical line number -> re-parsed row, filled in by Arrow while it reads ahead
+        invalid_rows: dict[int, list[str]] = {}
+
+        def on_invalid_row(row) -> str:
+            invalid_rows[row.number] = next(csv.reader([row.text], delimiter=delimiter), [])
+            return "skip"
+
+        column_names = [f"f{i}" for i in range(len(header))]
+        with pa.input_stream(str(path)) as stream:
+            reader = pa_csv.open_csv(
+                stream,
+                read_options=pa_csv.ReadOptions(column_names=column_names, skip_rows=1, block_size=block_size),
+                parse_options=pa_csv.ParseOptions(
+                    delimiter=delimiter,
+                    newlines_in_values=True,
+                    ignore_empty_lines=False,
+                    invalid_row_handler=on_invalid_row,
+                ),
+                convert_options=pa_csv.ConvertOptions(
+                    column_types={name: pa.string() for name in column_names},
+                    strings_can_be_null=False,
+                    quoted_strings_can_be_null=False,
+                ),
+            )
+            next_line = 2 # The header is line 1
+            for batch in reader:
+                for row in zip(*(column.to_pylist() for column in batch.columns)):
+                    while next_line in invalid_rows:
+                        yield invalid_rows.pop(next_line)
+                        next_line += 1
+                    yield list(row) if any(row) else [] # Blank line, as csv.reader reports it
+                    next_line += 1
+            for line in sorted(invalid_rows):
+                yield invalid_rows[line]
+
+    return rows()
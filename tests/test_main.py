@@ -1,55 +1,152 @@
 import pytest
+import asyncio
+import itertools
+import logging
+import typer
 from typer.testing import CliRunner
 from pathlib import Path
 from unittest import mock
-import os
-import csv # Added missing import based on previous attempt's SEARCH block
-import shutil # Added missing import based on previous attempt's SEARCH block
 
-from sfx_batch.main import app, SFXClient as MockSFXClient # Import the app and the mock client
-from sfx_batch.main import ElevenLabsAPIKeyError, ElevenLabsParameterError, ElevenLabsGenerationError, ElevenLabsRateLimitError
+from sfx_batch.main import app, run_batch, iter_prompts, iter_prompts_vectorized, _call_with_retry # Import the app
+from sfx_batch.main import ElevenLabsParameterError, ElevenLabsGenerationError, ElevenLabsRateLimitError
 
 runner = CliRunner()
 
-# Fixture for a temporary CSV file
-@pytest.fixture
-def temp_csv_file(tmp_path: Path) -> Path:
-    csv_content = (
-        "SFX_Prompt;Notes;TargetFile\n"
-        '"A loud thunder clap with rain";For storm scene;"thunder_clap.mp3"\n'
-        "Gentle wind blowing through trees;Ambient background for forest;forest_wind.mp3\n"
-        '"Spaceship door hissing open";Sci-fi project;sfx_door_open.mp3\n'
-        "A single, clear bell toll;;bell.mp3\n"
-        "Prompt for param error;causes;parameter_error_sfx\n" # For testing mock client errors
-        "Prompt for gen error;causes;generation_error_sfx\n"
-        "Prompt for rate limit;causes;rate_limit_sfx\n"
-        ";Empty prompt line test;empty.mp3\n" # Empty prompt
-        "Valid prompt but too few columns\n" # Malformed row
-    )
-    csv_file = tmp_path / "test_prompts.csv"
-    # Write with utf-8-sig to simulate BOM
-    with open(csv_file, "w", encoding="utf-8-sig") as f:
-        f.write(csv_content)
+CSV_CONTENT = ( # Pre-encoded, so fixtures only write bytes
+    b"SFX_Prompt;Notes;TargetFile\n"
+    b'"A loud thunder clap with rain";For storm scene;"thunder_clap.mp3"\n'
+    b"Gentle wind blowing through trees;Ambient background for forest;forest_wind.mp3\n"
+    b'"Spaceship door hissing open";Sci-fi project;sfx_door_open.mp3\n'
+    b"A single, clear bell toll;;bell.mp3\n"
+    b"Prompt for param error;causes;parameter_error_sfx\n" # For testing mock client errors
+    b"Prompt for gen error;causes;generation_error_sfx\n"
+    b"Prompt for rate limit;causes;rate_limit_sfx\n"
+    b";Empty prompt line test;empty.mp3\n" # Empty prompt
+    b"Valid prompt but too few columns\n" # Malformed row
+)
+
+# Comma-delimited, with duration and influence columns
+OPTIONS_CSV_CONTENT = (
+    b"prompt_text,notes,custom_duration,custom_influence\n"
+    b'"Prompt A","Note A",2.5,0.7\n' # Valid duration and influence
+    b'"Prompt B","Note B",,0.2\n'      # Empty duration (use global), valid influence
+    b'"Prompt C","Note C",3.0,\n'      # Valid duration, empty influence (use global)
+    b'"Prompt D","Note D",invalid,0.9\n' # Invalid duration (use global), valid influence
+    b'"Prompt E","Note E",7.5,invalid\n' # Valid duration, invalid influence (use global)
+    b'"Prompt F","Note F",0.1,0.5\n'    # Duration out of range (use global)
+    b'"Prompt G","Note G",10.0,1.5\n'   # Influence out of range (use global)
+    b'"Prompt H","Note H",\n'          # Empty duration and influence (use globals)
+)
+
+# Pre-encoded UTF-8-SIG contents for the header-only and empty CSV tests
+_BOM = b"\xef\xbb\xbf"
+_EMPTY_CSV = _BOM + b"Header1;Header2\n" # Only header
+_HEADER_ONLY_NO_NL_CSV = _BOM + b"Header1;Header2"
+
+# Input CSVs are only ever read, so each is written once per session
+@pytest.fixture(scope="session")
+def temp_csv_file(tmp_path_factory) -> Path:
+    csv_file = tmp_path_factory.mktemp("csv") / "test_prompts.csv"
+    csv_file.write_bytes(_BOM + CSV_CONTENT) # With BOM, to exercise BOM handling
     return csv_file
 
+# One parent directory per session (per xdist worker); tests get fresh, not-yet-created
+# paths below it instead of a new tmp_path directory each.
+_scratch_ids = itertools.count()
+
+@pytest.fixture(scope="session")
+def scratch_root(tmp_path_factory) -> Path:
+    return tmp_path_factory.mktemp("scratch")
+
 @pytest.fixture
-def temp_output_dir_for_cli(tmp_path: Path) -> Path:
-    output_dir = tmp_path / "cli_test_output"
+def temp_output_dir_for_cli(scratch_root: Path) -> Path:
+    output_dir = scratch_root / f"cli_test_output_{next(_scratch_ids)}"
     # No need to mkdir here, the app should do it.
     return output_dir
 
-# Mock environment variable for API key
-@pytest.fixture(autouse=True)
-def mock_env_api_key(monkeypatch):
+# Mock environment variable for API key (requested only by tests that rely on it)
+@pytest.fixture
+def env_api_key(monkeypatch):
     monkeypatch.setenv("ELEVENLABS_API_KEY", "test_env_api_key")
 
-# To capture logs
+# Keep the persistent audio cache out of the user's home directory and isolated per test
+@pytest.fixture(autouse=True)
+def isolated_cache_dir(monkeypatch, scratch_root: Path) -> Path:
+    cache_dir = scratch_root / f"sfx_cache_{next(_scratch_ids)}"
+    monkeypatch.setenv("SFX_BATCH_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+# Stand-in for the ElevenLabs client; records every request it receives and fails the
+# error prompts in CSV_CONTENT the way the real client would
+class FakeSFXClient:
+    last = None # Most recently constructed instance
+
+    def __init__(self, api_key, max_retries=3):
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.calls = []
+        FakeSFXClient.last = self
+
+    def generate_sound_effect(self, **kwargs):
+        self.calls.append(kwargs) # list.append is thread-safe; calls arrive from worker threads
+        text = kwargs["text"]
+        if "param error" in text:
+            raise ElevenLabsParameterError(f"Invalid parameter for prompt: {text}")
+        if "gen error" in text:
+            raise ElevenLabsGenerationError(f"Failed to generate sound for prompt: {text}")
+        if "rate limit" in text:
+            raise ElevenLabsRateLimitError("Rate limit exceeded.")
+        return b"mock_audio"
+
+# Autouse so no CLI test can reach the real API; request it by name to inspect the calls
+@pytest.fixture(autouse=True)
+def fake_sfx_client(monkeypatch) -> type[FakeSFXClient]:
+    monkeypatch.setattr(FakeSFXClient, "last", None)
+    monkeypatch.setattr("sfx_batch.main.RETRY_BACKOFF_BASE", 0) # Don't wait between retries of the error prompts
+    monkeypatch.setattr("sfx_batch.main.ElevenLabsSFXClient", FakeSFXClient)
+    return FakeSFXClient
+
+# load_dotenv() searches the filesystem for a .env file on every run; only tests marked
+# with @pytest.mark.dotenv actually need that.
+@pytest.fixture(autouse=True)
+def _noop_dotenv(monkeypatch, request):
+    if request.node.get_closest_marker("dotenv") is None:
+        monkeypatch.setattr("sfx_batch.main.load_dotenv", lambda *args, **kwargs: False)
+
+# Working directory containing a .env file, so it is found by load_dotenv()
+@pytest.fixture
+def dotenv_dir(tmp_path: Path, monkeypatch) -> Path:
+    (tmp_path / ".env").write_text('ELEVENLABS_API_KEY="dotenv_api_key"')
+    monkeypatch.chdir(tmp_path) # Restored automatically
+    return tmp_path
+
+# Captured log messages, formatted once per record instead of re-joining caplog.text on every check
+class LogLines:
+    def __init__(self, caplog):
+        self.caplog = caplog
+        self._lines = []
+
+    @property
+    def lines(self) -> list[str]:
+        records = self.caplog.records
+        if len(records) < len(self._lines): # caplog was cleared behind our back
+            self._lines = []
+        self._lines.extend(record.getMessage() for record in records[len(self._lines):])
+        return self._lines
+
+    def __contains__(self, text: str) -> bool:
+        return any(text in line for line in self.lines)
+
+# To capture logs. Most tests only check INFO and above, so DEBUG records are not even created for them.
 @pytest.fixture
-def log_capture(caplog):
-    import logging
+def log_capture_info(caplog) -> LogLines:
     caplog.set_level(logging.INFO, logger="sfx_batch.main")
+    return LogLines(caplog)
+
+@pytest.fixture
+def log_capture_debug(caplog) -> LogLines:
     caplog.set_level(logging.DEBUG, logger="sfx_batch.main") # Capture debug from app's logger
-    return caplog
+    return LogLines(caplog)
 
 
 class TestCliMain:
@@ -71,91 +168,85 @@ class TestCliMain:
         assert result.exit_code != 0 # Typer handles this, exit code is 2
         assert "Missing option '--prompt-column'" in result.stderr
 
-    def test_api_key_missing(self, temp_csv_file: Path, monkeypatch):
+    # Tests below that don't exercise argument parsing call the command function directly,
+    # skipping CliRunner's Click context setup and output redirection.
+    def test_api_key_missing(self, temp_csv_file: Path, monkeypatch, isolated_cache_dir: Path, log_capture_info):
         monkeypatch.delenv("ELEVENLABS_API_KEY", raising=False) # Remove env key
-        result = runner.invoke(app, [str(temp_csv_file), "--prompt-column", "0"]) # No --api-key arg
-        assert result.exit_code == 1
-        assert "ElevenLabs API key not found" in result.stdout # Logged as error
-        assert "Exiting due to missing API key." in result.stdout
+        with pytest.raises(typer.Exit) as exc_info:
+            run_batch(csv_file=temp_csv_file, prompt_column="0", cache_dir=isolated_cache_dir) # No api_key
+        assert exc_info.value.exit_code == 1
+        assert "ElevenLabs API key not found" in log_capture_info # Logged as error
+        assert "Exiting due to missing API key." in log_capture_info
 
-    def test_api_key_from_cli_arg(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, monkeypatch, log_capture):
+    def test_api_key_from_cli_arg(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, monkeypatch, fake_sfx_client, log_capture_debug):
         monkeypatch.delenv("ELEVENLABS_API_KEY", raising=False) # Ensure env key is not used
         
-        # Mock the SFXClient to check how it's initialized
-        with mock.patch("sfx_batch.main.SFXClient") as MockedSFXClientInstance: # Changed sfxbatch to sfx_batch
-            mock_sfx_instance = MockedSFXClientInstance.return_value
-            mock_sfx_instance.generate_sound_effect.return_value = b"mock_audio"
-
-            result = runner.invoke(app, [
-                str(temp_csv_file),
-                "--prompt-column", "0",
-                "--api-key", "test_cli_api_key",
-                "--output-dir", str(temp_output_dir_for_cli)
-            ])
+        result = runner.invoke(app, [
+            str(temp_csv_file),
+            "--prompt-column", "0",
+            "--api-key", "test_cli_api_key",
+            "--output-dir", str(temp_output_dir_for_cli)
+        ])
 
         assert result.exit_code == 0
-        MockedSFXClientInstance.assert_called_once_with(api_key="test_cli_api_key", max_retries=3)
-        assert "Using API key from --api-key argument." in log_capture.text
-        assert temp_output_dir_for_cli.exists()
+        assert (fake_sfx_client.last.api_key, fake_sfx_client.last.max_retries) == ("test_cli_api_key", 0)
+        assert "Using API key from --api-key argument." in log_capture_debug
+        assert any(temp_output_dir_for_cli.iterdir())
 
-    def test_successful_run_with_column_name(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, log_capture):
+    def test_successful_run_with_column_name(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, env_api_key, log_capture_info):
         result = runner.invoke(app, [
             str(temp_csv_file),
             "--prompt-column", "SFX_Prompt", # Use column name
             "--output-dir", str(temp_output_dir_for_cli)
         ])
         assert result.exit_code == 0
-        assert "sfx-batch processing finished." in result.stdout # Changed sfxbatch to sfx-batch
-        assert temp_output_dir_for_cli.exists()
+        assert "sfx-batch processing finished." in log_capture_info
+        assert any(temp_output_dir_for_cli.iterdir())
         
         # Expected files based on CSV content (excluding error prompts and empty/malformed)
         # "A loud thunder clap with rain" -> a_loud_thunder_clap_with_rain.mp3
         # "Gentle wind blowing through trees" -> gentle_wind_blowing_through_trees.mp3
         # "Spaceship door hissing open" -> spaceship_door_hissing_open.mp3
         # "A single, clear bell toll" -> a_single_clear_bell_toll.mp3
-        # Total 4 valid files from the main prompts.
+        # "Valid prompt but too few columns" -> only the prompt column is required
+        # Total 5 valid files from the main prompts.
         # The error prompts will be processed but log errors.
         
         # Check number of "Saved:" messages
-        saved_logs = [line for line in log_capture.text.splitlines() if "Saved:" in line]
+        saved_count = sum(1 for line in log_capture_info.lines if line.startswith("Saved:"))
         # Mock client generates for all, even error ones, unless error is in client init
         # The mock client raises errors for specific prompt texts
         # "Prompt for param error" -> logs error, failed_count++
         # "Prompt for gen error" -> logs error, failed_count++
         # "Prompt for rate limit" -> logs error, failed_count++
-        # So, 4 successful, 3 failed.
-        assert len(saved_logs) == 4 
+        # So, 5 successful, 3 failed.
+        assert saved_count == 5
         assert (temp_output_dir_for_cli / "a_loud_thunder_clap_with_rain.mp3").exists()
         assert (temp_output_dir_for_cli / "gentle_wind_blowing_through_trees.mp3").exists()
         assert (temp_output_dir_for_cli / "spaceship_door_hissing_open.mp3").exists()
         assert (temp_output_dir_for_cli / "a_single_clear_bell_toll.mp3").exists()
-
-        assert "Successfully generated 4 sound effects." in result.stdout
-        assert "Failed to generate 3 sound effects." in result.stdout # Due to mock client errors
-
-        # Check for warnings about empty/malformed rows
-        assert "Skipping row 8 due to empty prompt" in log_capture.text # Row 8 in CSV (1-indexed)
-        assert "Skipping malformed row 9" in log_capture.text # Row 9 in CSV
-
-    def test_invalid_prompt_column_name(self, temp_csv_file: Path, temp_output_dir_for_cli: Path):
-        result = runner.invoke(app, [
-            str(temp_csv_file),
-            "--prompt-column", "NonExistentColumn",
-            "--output-dir", str(temp_output_dir_for_cli)
-        ])
-        assert result.exit_code == 1
-        assert "Prompt column name 'NonExistentColumn' not found in CSV header" in result.stdout
-
-    def test_invalid_prompt_column_index(self, temp_csv_file: Path, temp_output_dir_for_cli: Path):
-        result = runner.invoke(app, [
-            str(temp_csv_file),
-            "--prompt-column", "10", # Index out of bounds
-            "--output-dir", str(temp_output_dir_for_cli)
-        ])
-        assert result.exit_code == 1
-        assert "Prompt column index 10 is out of range" in result.stdout
+        assert (temp_output_dir_for_cli / "valid_prompt_but_too_few_columns.mp3").exists()
+
+        assert "Successfully generated 5 sound effects." in log_capture_info
+        assert "Failed to generate 3 sound effects." in log_capture_info # Due to mock client errors
+
+        # Row 9 (1-indexed, header is row 1) has an empty prompt; row 10 has every column it needs
+        assert "Skipping row 9 due to empty prompt" in log_capture_info
+        assert "Skipping malformed row" not in log_capture_info
+
+    def test_invalid_prompt_column_name(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, env_api_key, isolated_cache_dir: Path, log_capture_info):
+        with pytest.raises(typer.Exit) as exc_info:
+            run_batch(csv_file=temp_csv_file, prompt_column="NonExistentColumn", output_dir=temp_output_dir_for_cli, cache_dir=isolated_cache_dir)
+        assert exc_info.value.exit_code == 1
+        assert "Prompt column name 'NonExistentColumn' not found in CSV header" in log_capture_info
+
+    def test_invalid_prompt_column_index(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, env_api_key, isolated_cache_dir: Path, log_capture_info):
+        with pytest.raises(typer.Exit) as exc_info:
+            run_batch(csv_file=temp_csv_file, prompt_column="10", output_dir=temp_output_dir_for_cli, cache_dir=isolated_cache_dir) # Index out of bounds
+        assert exc_info.value.exit_code == 1
+        assert "Prompt column index 10 is out of range" in log_capture_info
         
-    def test_output_dir_creation(self, temp_csv_file: Path, temp_output_dir_for_cli: Path):
+    def test_output_dir_creation(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, env_api_key):
         assert not temp_output_dir_for_cli.exists() # Ensure it doesn't exist before run
         result = runner.invoke(app, [
             str(temp_csv_file),
@@ -166,29 +257,27 @@ class TestCliMain:
         assert temp_output_dir_for_cli.exists()
         assert temp_output_dir_for_cli.is_dir()
 
-    def test_verbose_and_debug_logging(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, log_capture):
-        # Test verbose
+    def test_verbose_logging(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, env_api_key, log_capture_info):
         runner.invoke(app, [
             str(temp_csv_file), "--prompt-column", "0", "--output-dir", str(temp_output_dir_for_cli), "-v"
         ])
-        assert "Verbose logging enabled (INFO level)." in log_capture.text
-        
-        log_capture.clear() # Clear logs for next run
-
-        # Test debug
-        # Need to mock SFXClient init to avoid API key error if env var is somehow unset by other tests
-        with mock.patch("sfx_batch.main.SFXClient") as MockedSFXClientInstance:
-            mock_sfx_instance = MockedSFXClientInstance.return_value
-            mock_sfx_instance.generate_sound_effect.return_value = b"mock_audio"
-            
-            runner.invoke(app, [
-                str(temp_csv_file), "--prompt-column", "0", "--output-dir", str(temp_output_dir_for_cli), "--debug", "--api-key", "debugkey"
-            ])
-        assert "Debug logging enabled." in log_capture.text
-        assert "Mock SFXClient initialized with API key: *****key" in log_capture.text # Debug log from mock client
-        assert "CSV Header:" in log_capture.text # Debug log from CSV processing
+        assert "Verbose logging enabled (INFO level)." in log_capture_info
 
-    def test_mock_sfx_client_errors(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, log_capture):
+    def test_debug_logging(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, log_capture_debug):
+        # Explicit --api-key, so this does not depend on the environment
+        runner.invoke(app, [
+            str(temp_csv_file), "--prompt-column", "0", "--output-dir", str(temp_output_dir_for_cli), "--debug", "--api-key", "debugkey"
+        ])
+        assert "Debug logging enabled." in log_capture_debug
+        assert FakeSFXClient.last.api_key == "debugkey"
+        assert "CSV Header:" in log_capture_debug # Debug log from CSV processing
+
+    @pytest.mark.parametrize("row, expected", [
+        (6, "Parameter Error for prompt from row 6 ('Prompt for param error'): Invalid parameter for prompt: Prompt for param error"),
+        (7, "Generation Error for prompt from row 7 ('Prompt for gen error'): Failed to generate sound for prompt: Prompt for gen error"),
+        (8, "Rate Limit Error for prompt from row 8 ('Prompt for rate limit'): Rate limit exceeded."),
+    ])
+    def test_mock_sfx_client_error_row(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, env_api_key, log_capture_info, row, expected):
         result = runner.invoke(app, [
             str(temp_csv_file),
             "--prompt-column", "SFX_Prompt", # This column contains "Prompt for param error", etc.
@@ -196,37 +285,26 @@ class TestCliMain:
         ])
         assert result.exit_code == 0 # App finishes, but logs errors
         
-        assert "Parameter Error for prompt from row 5 ('Prompt for param error'): Invalid parameter for prompt: Prompt for param error" in log_capture.text
-        assert "Generation Error for prompt from row 6 ('Prompt for gen error'): Failed to generate sound for prompt: Prompt for gen error" in log_capture.text
-        assert "Rate Limit Error for prompt from row 7 ('Prompt for rate limit'): Rate limit exceeded." in log_capture.text
-        assert "Failed to generate 3 sound effects." in result.stdout
+        assert expected in log_capture_info
+        assert "Failed to generate 3 sound effects." in log_capture_info
 
-    def test_empty_csv(self, tmp_path: Path, temp_output_dir_for_cli: Path):
+    @pytest.mark.parametrize("content", [_EMPTY_CSV, _HEADER_ONLY_NO_NL_CSV], ids=["header_only", "header_only_no_newline"])
+    def test_empty_csv(self, tmp_path: Path, temp_output_dir_for_cli: Path, env_api_key, log_capture_info, content):
         empty_csv = tmp_path / "empty.csv"
-        empty_csv.write_text("Header1;Header2\n", encoding="utf-8-sig") # Only header
-        
-        result = runner.invoke(app, [
-            str(empty_csv),
-            "--prompt-column", "Header1",
-            "--output-dir", str(temp_output_dir_for_cli)
-        ])
-        assert result.exit_code == 0 # Exits cleanly
-        assert "No valid prompts found in the CSV file." in result.stdout
+        empty_csv.write_bytes(content)
 
-        only_header_no_nl = tmp_path / "only_header.csv"
-        only_header_no_nl.write_text("Header1;Header2", encoding="utf-8-sig")
         result = runner.invoke(app, [
-            str(only_header_no_nl),
+            str(empty_csv),
             "--prompt-column", "Header1",
             "--output-dir", str(temp_output_dir_for_cli)
         ])
         assert result.exit_code == 0 # Exits cleanly
-        assert "No valid prompts found in the CSV file." in result.stdout
+        assert "No valid prompts found in the CSV file." in log_capture_info
 
 
-    def test_csv_no_header(self, tmp_path: Path, temp_output_dir_for_cli: Path):
+    def test_csv_no_header(self, tmp_path: Path, temp_output_dir_for_cli: Path, env_api_key, log_capture_info):
         no_header_csv = tmp_path / "no_header.csv"
-        no_header_csv.write_text("", encoding="utf-8-sig") # Completely empty
+        no_header_csv.write_bytes(_BOM) # Completely empty
         
         result = runner.invoke(app, [
             str(no_header_csv),
@@ -234,69 +312,219 @@ class TestCliMain:
             "--output-dir", str(temp_output_dir_for_cli)
         ])
         assert result.exit_code == 1
-        assert "CSV file 'no_header.csv' is empty or has no header." in result.stdout
+        assert "CSV file 'no_header.csv' is empty or has no header." in log_capture_info
 
     # --- Tests for new CSV features (delimiter, per-prompt duration/influence) ---
 
-    @pytest.fixture
-    def csv_for_options_test(self, tmp_path: Path) -> Path:
-        # Comma-delimited, with duration and influence columns
-        content = (
-            "prompt_text,notes,custom_duration,custom_influence\n"
-            '"Prompt A","Note A",2.5,0.7\n' # Valid duration and influence
-            '"Prompt B","Note B",,0.2\n'      # Empty duration (use global), valid influence
-            '"Prompt C","Note C",3.0,\n'      # Valid duration, empty influence (use global)
-            '"Prompt D","Note D",invalid,0.9\n' # Invalid duration (use global), valid influence
-            '"Prompt E","Note E",7.5,invalid\n' # Valid duration, invalid influence (use global)
-            '"Prompt F","Note F",0.1,0.5\n'    # Duration out of range (use global)
-            '"Prompt G","Note G",10.0,1.5\n'   # Influence out of range (use global)
-            '"Prompt H","Note H",\n'          # Empty duration and influence (use globals)
-        )
-        csv_file = tmp_path / "options_test.csv"
-        csv_file.write_text(content, encoding="utf-8")
+    @pytest.fixture(scope="session")
+    def csv_for_options_test(self, tmp_path_factory) -> Path:
+        csv_file = tmp_path_factory.mktemp("csv") / "options_test.csv"
+        csv_file.write_bytes(OPTIONS_CSV_CONTENT)
         return csv_file
 
-    def test_custom_delimiter(self, csv_for_options_test: Path, temp_output_dir_for_cli: Path, log_capture):
-        with mock.patch("sfx_batch.main.ElevenLabsSFXClient") as MockedSFXClientInstance:
-            mock_sfx_instance = MockedSFXClientInstance.return_value
-            mock_sfx_instance.generate_sound_effect.return_value = b"mock_audio"
+    def test_custom_delimiter(self, csv_for_options_test: Path, temp_output_dir_for_cli: Path, fake_sfx_client, log_capture_info):
+        result = runner.invoke(app, [
+            str(csv_for_options_test),
+            "--prompt-column", "prompt_text",
+            "--delimiter", ",",
+            "--api-key", "testkey", # Provide API key to pass that check
+            "--output-dir", str(temp_output_dir_for_cli)
+        ])
+        assert result.exit_code == 0, result.stdout
+        assert "CSV Delimiter: ','" in log_capture_info
+        # Check if prompts were processed (implies correct delimiter)
+        # 8 prompts in csv_for_options_test
+        assert "Found 8 prompts to process." in log_capture_info
+        assert len(fake_sfx_client.last.calls) == 8
+
 
+    def test_max_concurrency_option(self, csv_for_options_test: Path, temp_output_dir_for_cli: Path, fake_sfx_client, log_capture_info):
+        result = runner.invoke(app, [
+            str(csv_for_options_test),
+            "--prompt-column", "prompt_text",
+            "--delimiter", ",",
+            "--api-key", "testkey",
+            "--output-dir", str(temp_output_dir_for_cli),
+            "--max-concurrency", "2",
+        ])
+        assert result.exit_code == 0, result.stdout
+        assert "Max concurrent API requests: 2" in log_capture_info
+        assert len(fake_sfx_client.last.calls) == 8
+        assert len(list(temp_output_dir_for_cli.glob("*.mp3"))) == 8
+
+
+    def test_cache_reused_across_runs(self, csv_for_options_test: Path, tmp_path: Path, isolated_cache_dir: Path, fake_sfx_client, log_capture_info):
+        for run in ("first", "second"):
             result = runner.invoke(app, [
                 str(csv_for_options_test),
                 "--prompt-column", "prompt_text",
                 "--delimiter", ",",
-                "--api-key", "testkey", # Provide API key to pass that check
-                "--output-dir", str(temp_output_dir_for_cli)
+                "--api-key", "testkey",
+                "--output-dir", str(tmp_path / run),
             ])
+            assert result.exit_code == 0, result.stdout
+
+        # The second run is served entirely from the cache
+        assert fake_sfx_client.last.calls == []
+        assert len(list(isolated_cache_dir.glob("*.mp3"))) == 8
+        assert "Cache hits: 8, cache misses: 0." in log_capture_info
+        assert (tmp_path / "second" / "prompt_a.mp3").read_bytes() == b"mock_audio"
+
+    def test_no_cache_flag(self, csv_for_options_test: Path, temp_output_dir_for_cli: Path, isolated_cache_dir: Path, log_capture_info):
+        result = runner.invoke(app, [
+            str(csv_for_options_test),
+            "--prompt-column", "prompt_text",
+            "--delimiter", ",",
+            "--api-key", "testkey",
+            "--output-dir", str(temp_output_dir_for_cli),
+            "--no-cache",
+        ])
         assert result.exit_code == 0, result.stdout
-        assert "CSV Delimiter: ','" in log_capture.text
-        # Check if prompts were processed (implies correct delimiter)
-        # 8 prompts in csv_for_options_test
-        assert "Found 8 prompts to process." in log_capture.text
-        assert MockedSFXClientInstance.return_value.generate_sound_effect.call_count == 8
+        assert not isolated_cache_dir.exists()
+        assert "Cache hits" not in log_capture_info
+
+    @pytest.mark.parametrize("flag, expected_calls", [("--skip-existing", 7), ("--no-skip-existing", 8)])
+    def test_skip_existing(self, csv_for_options_test: Path, temp_output_dir_for_cli: Path, fake_sfx_client, log_capture_info, flag, expected_calls):
+        temp_output_dir_for_cli.mkdir(parents=True, exist_ok=True)
+        (temp_output_dir_for_cli / "prompt_a.mp3").write_bytes(b"previous_run")
+        result = runner.invoke(app, [
+            str(csv_for_options_test),
+            "--prompt-column", "prompt_text",
+            "--delimiter", ",",
+            "--api-key", "testkey",
+            "--output-dir", str(temp_output_dir_for_cli),
+            "--no-cache",
+            flag,
+        ])
+        assert result.exit_code == 0, result.stdout
+        assert len(fake_sfx_client.last.calls) == expected_calls
+        assert (temp_output_dir_for_cli / "prompt_a.mp3").read_bytes() == b"previous_run"
+        assert (temp_output_dir_for_cli / "prompt_a_1.mp3").exists() == (flag == "--no-skip-existing")
+
+    def test_duplicate_prompts_share_one_api_call(self, tmp_path: Path, temp_output_dir_for_cli: Path, fake_sfx_client, log_capture_info):
+        csv_file = tmp_path / "duplicates.csv"
+        csv_file.write_text("prompt;duration\nWind;2\nRain;2\nWind;2.0\nWind;3\n", encoding="utf-8")
+        result = runner.invoke(app, [
+            str(csv_file),
+            "--prompt-column", "prompt",
+            "--duration-column", "duration",
+            "--api-key", "testkey",
+            "--output-dir", str(temp_output_dir_for_cli),
+            "--no-cache",
+        ])
+        assert result.exit_code == 0, result.stdout
+        # "Wind" at 2s appears twice; "Wind" at 3s is a distinct request
+        assert len(fake_sfx_client.last.calls) == 3
+        assert sorted(p.name for p in temp_output_dir_for_cli.iterdir()) == ["rain.mp3", "wind.mp3", "wind_1.mp3", "wind_2.mp3"]
+        assert "Reused audio for 1 duplicate prompts" in log_capture_info
+
+    def test_late_duplicates_without_cache_copy_the_saved_file(self, tmp_path: Path, temp_output_dir_for_cli: Path, fake_sfx_client):
+        # By the time the last "Wind" row is reached the first one has long been saved,
+        # so its audio comes from that file rather than from memory or the API
+        csv_file = tmp_path / "late_duplicates.csv"
+        csv_file.write_text("prompt\nWind\n" + "".join(f"Prompt {i}\n" for i in range(20)) + "Wind\n", encoding="utf-8")
+        result = runner.invoke(app, [
+            str(csv_file),
+            "--prompt-column", "prompt",
+            "--api-key", "testkey",
+            "--output-dir", str(temp_output_dir_for_cli),
+            "--max-concurrency", "1",
+            "--no-cache",
+        ])
+        assert result.exit_code == 0, result.stdout
+        assert len(fake_sfx_client.last.calls) == 21
+        assert (temp_output_dir_for_cli / "wind_1.mp3").read_bytes() == (temp_output_dir_for_cli / "wind.mp3").read_bytes()
 
+    def test_rate_limit_options_build_limiters(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, monkeypatch):
+        received = []
 
-    def test_per_prompt_duration_and_influence(self, csv_for_options_test: Path, temp_output_dir_for_cli: Path, log_capture):
-        with mock.patch("sfx_batch.main.ElevenLabsSFXClient") as MockedSFXClientInstance:
-            mock_sfx_instance = MockedSFXClientInstance.return_value
-            mock_sfx_instance.generate_sound_effect.return_value = b"mock_audio"
+        async def fake_process_all(prompts, sfx_client, allocator, cache_dir, max_concurrency, rate_limiters, *args):
+            received.extend(rate_limiters)
+            return dict.fromkeys(["prompts", "generated", "failed", "skipped", "cache_hits", "cache_misses", "deduplicated"], 0)
 
+        monkeypatch.setattr("sfx_batch.main._process_all", fake_process_all)
+        result = runner.invoke(app, [
+            str(temp_csv_file),
+            "--prompt-column", "0",
+            "--api-key", "testkey",
+            "--output-dir", str(temp_output_dir_for_cli),
+            "--rps", "2",
+            "--rpm", "30",
+        ])
+        assert result.exit_code == 0, result.stdout
+        # Per-second then per-minute bucket, both evenly paced
+        assert [(limiter.refill_per_second, limiter.capacity) for limiter in received] == [(2.0, 1.0), (0.5, 1.0)]
+
+    def test_write_errors_are_counted_as_failures(self, csv_for_options_test: Path, temp_output_dir_for_cli: Path, fake_sfx_client, monkeypatch, log_capture_info):
+        monkeypatch.setattr("sfx_batch.main.write_new_file", mock.Mock(side_effect=OSError("disk full")))
+        result = runner.invoke(app, [
+            str(csv_for_options_test),
+            "--prompt-column", "prompt_text",
+            "--delimiter", ",",
+            "--api-key", "testkey",
+            "--output-dir", str(temp_output_dir_for_cli),
+            "--no-cache",
+        ])
+        assert result.exit_code == 0, result.stdout
+        assert "disk full" in log_capture_info
+        assert "Successfully generated 0 sound effects." in log_capture_info
+        assert "Failed to generate 8 sound effects." in log_capture_info
+
+    def test_unexpected_write_errors_do_not_stall_the_batch(self, tmp_path: Path, temp_output_dir_for_cli: Path, monkeypatch, log_capture_info):
+        # A client returning str instead of bytes breaks every write; more prompts than
+        # the writer queue holds must still all be reported as failed, not hang
+        monkeypatch.setattr(FakeSFXClient, "generate_sound_effect", lambda self, **kwargs: "not bytes")
+        csv_file = tmp_path / "many.csv"
+        csv_file.write_text("prompt\n" + "".join(f"Prompt {i}\n" for i in range(40)), encoding="utf-8")
+        result = runner.invoke(app, [
+            str(csv_file),
+            "--prompt-column", "prompt",
+            "--api-key", "testkey",
+            "--output-dir", str(temp_output_dir_for_cli),
+            "--max-concurrency", "1",
+            "--no-cache",
+        ])
+        assert result.exit_code == 0, result.stdout
+        assert "Failed to generate 40 sound effects." in log_capture_info
+
+    def test_pyarrow_csv_engine_matches_python_engine(self, csv_for_options_test: Path, tmp_path: Path, fake_sfx_client):
+        pytest.importorskip("pyarrow")
+        requested = {}
+        for engine in ("python", "pyarrow"):
             result = runner.invoke(app, [
                 str(csv_for_options_test),
-                "--prompt-column", "0", # Use index for prompt
+                "--prompt-column", "prompt_text",
                 "--delimiter", ",",
-                "--duration-column", "custom_duration", # Use name for duration col
-                "--influence-column", "3", # Use index for influence col
+                "--duration-column", "custom_duration",
+                "--influence-column", "custom_influence",
                 "--api-key", "testkey",
-                "--output-dir", str(temp_output_dir_for_cli),
-                "--duration", "5.0", # Global duration
-                "--prompt-influence", "0.3" # Global influence
+                "--output-dir", str(tmp_path / engine),
+                "--no-cache",
+                "--csv-engine", engine,
             ])
+            assert result.exit_code == 0, result.stdout
+            requested[engine] = sorted(sorted(kwargs.items()) for kwargs in fake_sfx_client.last.calls)
+        assert len(requested["python"]) == 8
+        assert requested["pyarrow"] == requested["python"]
+
+
+    def test_per_prompt_duration_and_influence(self, csv_for_options_test: Path, temp_output_dir_for_cli: Path, fake_sfx_client, log_capture_info):
+        result = runner.invoke(app, [
+            str(csv_for_options_test),
+            "--prompt-column", "0", # Use index for prompt
+            "--delimiter", ",",
+            "--duration-column", "custom_duration", # Use name for duration col
+            "--influence-column", "3", # Use index for influence col
+            "--api-key", "testkey",
+            "--output-dir", str(temp_output_dir_for_cli),
+            "--duration", "5.0", # Global duration
+            "--prompt-influence", "0.3" # Global influence
+        ])
 
         assert result.exit_code == 0, result.stdout
         
-        calls = MockedSFXClientInstance.return_value.generate_sound_effect.call_args_list
-        assert len(calls) == 8
+        # Prompts are generated concurrently, so compare in prompt order rather than call order.
+        calls = sorted(fake_sfx_client.last.calls, key=lambda kwargs: kwargs["text"])
 
         # Expected durations and influences (global defaults: duration=5.0, influence=0.3)
         # Prompt A: duration=2.5, influence=0.7
@@ -319,156 +547,75 @@ class TestCliMain:
             {"text": "Prompt H", "duration_seconds": 5.0, "prompt_influence": 0.3},
         ]
 
-        for i, call in enumerate(calls):
-            args, kwargs = call
-            assert kwargs['text'] == expected_params[i]['text']
-            assert kwargs['duration_seconds'] == expected_params[i]['duration_seconds']
-            assert kwargs['prompt_influence'] == expected_params[i]['prompt_influence']
-
-        # Check for warnings in logs
-        assert "Duration 'invalid' from CSV column 'custom_duration' is out of range" not in log_capture.text # Should be "Invalid duration value"
-        assert "Invalid duration value 'invalid' in CSV column 'custom_duration'" in log_capture.text # For Prompt D
-        assert "Invalid influence value 'invalid' in CSV column 'custom_influence'" in log_capture.text # For Prompt E
-        assert "Duration '0.1' from CSV column 'custom_duration' is out of range" in log_capture.text # For Prompt F
-        assert "Influence '1.5' from CSV column 'custom_influence' is out of range" in log_capture.text # For Prompt G
-        
-        # Check log messages for fallback
-        assert "Using global duration: 5.0s." in log_capture.text
-        assert "Using global influence: 0.3." in log_capture.text
+        assert calls == expected_params
 
+        # Check for aggregated warnings in logs (one per problem, not one per row)
+        assert "1 row had an invalid duration in CSV column 'custom_duration'; used global duration 5.0s (first: row 5)." in log_capture_info # For Prompt D
+        assert "1 row had an invalid influence in CSV column 'custom_influence'; used global influence 0.3 (first: row 6)." in log_capture_info # For Prompt E
+        assert "1 row had a duration out of range (0.5-22.0) in CSV column 'custom_duration'; used global duration 5.0s (first: row 7)." in log_capture_info # For Prompt F
+        assert "1 row had an influence out of range (0.0-1.0) in CSV column 'custom_influence'; used global influence 0.3 (first: row 8)." in log_capture_info # For Prompt G
+        assert "1 row lacked influence column 'custom_influence'; used global influence 0.3 (first: row 9)." in log_capture_info # For Prompt H
 
-    def test_duration_influence_cols_not_found(self, csv_for_options_test: Path, temp_output_dir_for_cli: Path, log_capture):
-         with mock.patch("sfx_batch.main.ElevenLabsSFXClient") as MockedSFXClientInstance:
-            mock_sfx_instance = MockedSFXClientInstance.return_value
-            mock_sfx_instance.generate_sound_effect.return_value = b"mock_audio"
-            result = runner.invoke(app, [
-                str(csv_for_options_test),
-                "--prompt-column", "prompt_text",
-                "--delimiter", ",",
-                "--duration-column", "NonExistentDurationCol",
-                "--influence-column", "NonExistentInfluenceCol",
-                "--api-key", "testkey",
-                "--output-dir", str(temp_output_dir_for_cli),
-                "--duration", "6.0", # Different global duration
-                "--prompt-influence", "0.6" # Different global influence
-            ])
-            assert result.exit_code == 0, result.stdout
-            assert "Duration column name 'NonExistentDurationCol' not found in CSV header. Will use global --duration." in log_capture.text
-            assert "Influence column name 'NonExistentInfluenceCol' not found in CSV header. Will use global --prompt-influence." in log_capture.text
 
-            # Verify all calls used global values
-            calls = MockedSFXClientInstance.return_value.generate_sound_effect.call_args_list
-            assert len(calls) == 8
-            for call in calls:
-                args, kwargs = call
-                assert kwargs['duration_seconds'] == 6.0
-                assert kwargs['prompt_influence'] == 0.6
+    def test_duration_influence_cols_not_found(self, csv_for_options_test: Path, temp_output_dir_for_cli: Path, fake_sfx_client, log_capture_info):
+        result = runner.invoke(app, [
+            str(csv_for_options_test),
+            "--prompt-column", "prompt_text",
+            "--delimiter", ",",
+            "--duration-column", "NonExistentDurationCol",
+            "--influence-column", "NonExistentInfluenceCol",
+            "--api-key", "testkey",
+            "--output-dir", str(temp_output_dir_for_cli),
+            "--duration", "6.0", # Different global duration
+            "--prompt-influence", "0.6" # Different global influence
+        ])
+        assert result.exit_code == 0, result.stdout
+        assert "Duration column name 'NonExistentDurationCol' not found in CSV header. Will use global --duration." in log_capture_info
+        assert "Influence column name 'NonExistentInfluenceCol' not found in CSV header. Will use global --prompt-influence." in log_capture_info
+
+        # Verify all calls used global values
+        requested = [(kwargs["duration_seconds"], kwargs["prompt_influence"]) for kwargs in fake_sfx_client.last.calls]
+        assert requested == [(6.0, 0.6)] * 8
 
 
     # Tests for .env file handling
-    def test_api_key_from_dotenv_file(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, monkeypatch, tmp_path, log_capture):
-        monkeypatch.delenv("ELEVENLABS_API_KEY", raising=False) # Remove shell env var
-        
-        # Create a .env file in the temporary test execution directory (which pytest sets as CWD for the test)
-        dot_env_file = tmp_path / ".env" 
-        dot_env_file.write_text('ELEVENLABS_API_KEY="dotenv_api_key"')
-        
-        original_cwd = os.getcwd()
-        os.chdir(tmp_path) # Change CWD so .env is found by load_dotenv()
-
-        try:
-            with mock.patch("sfx_batch.main.SFXClient") as MockedSFXClientInstance:
-                mock_sfx_instance = MockedSFXClientInstance.return_value
-                mock_sfx_instance.generate_sound_effect.return_value = b"mock_audio"
-
-                result = runner.invoke(app, [
-                    str(temp_csv_file), # Use the one from tmp_path fixture, ensure path is correct
-                    "--prompt-column", "0",
-                    "--output-dir", str(temp_output_dir_for_cli) 
-                    # No --api-key CLI arg, no shell env var
-                ])
-            
-            assert result.exit_code == 0, result.stdout
-            MockedSFXClientInstance.assert_called_once_with(api_key="dotenv_api_key", max_retries=3)
-            assert ".env file loaded." in log_capture.text # Check if load_dotenv reported success
-            assert "Using API key from ELEVENLABS_API_KEY environment variable." in log_capture.text # get_api_key logs this
-        finally:
-            os.chdir(original_cwd) # Restore CWD
-            if dot_env_file.exists():
-                dot_env_file.unlink()
+    @pytest.mark.dotenv
+    @pytest.mark.parametrize(
+        "shell_env, cli_key, expected_key, expected_log",
+        [
+            (None, None, "dotenv_api_key", "Using API key from ELEVENLABS_API_KEY environment variable."),
+            # CLI key wins over both the shell env var and .env
+            ("shell_env_api_key", "cli_api_key", "cli_api_key", "Using API key from --api-key argument."),
+            # python-dotenv's load_dotenv by default does NOT override existing shell env vars.
+            ("shell_env_api_key", None, "shell_env_api_key", "Using API key from ELEVENLABS_API_KEY environment variable."),
+        ]
+    )
+    def test_api_key_precedence(
+        self, temp_csv_file: Path, temp_output_dir_for_cli: Path, dotenv_dir: Path, monkeypatch, fake_sfx_client, log_capture_debug,
+        shell_env, cli_key, expected_key, expected_log
+    ):
+        if shell_env is None:
+            monkeypatch.delenv("ELEVENLABS_API_KEY", raising=False) # Remove shell env var
+        else:
+            monkeypatch.setenv("ELEVENLABS_API_KEY", shell_env)
 
+        args = [str(temp_csv_file), "--prompt-column", "0", "--output-dir", str(temp_output_dir_for_cli)]
+        if cli_key is not None:
+            args += ["--api-key", cli_key]
+        result = runner.invoke(app, args)
 
-    def test_cli_overrides_dotenv_and_shell_env(
-        self, temp_csv_file: Path, temp_output_dir_for_cli: Path, monkeypatch, tmp_path, log_capture
-    ):
-        # Set shell env var
-        monkeypatch.setenv("ELEVENLABS_API_KEY", "shell_env_api_key")
-        
-        # Create .env file
-        dot_env_file = tmp_path / ".env"
-        dot_env_file.write_text('ELEVENLABS_API_KEY="dotenv_api_key"')
-        
-        original_cwd = os.getcwd()
-        os.chdir(tmp_path)
-
-        try:
-            with mock.patch("sfx_batch.main.SFXClient") as MockedSFXClientInstance: # Changed sfxbatch to sfx_batch
-                mock_sfx_instance = MockedSFXClientInstance.return_value
-                mock_sfx_instance.generate_sound_effect.return_value = b"mock_audio"
-
-                result = runner.invoke(app, [
-                    str(temp_csv_file),
-                    "--prompt-column", "0",
-                    "--api-key", "cli_api_key", # CLI key should win
-                    "--output-dir", str(temp_output_dir_for_cli)
-                ])
-            
-            assert result.exit_code == 0, result.stdout
-            MockedSFXClientInstance.assert_called_once_with(api_key="cli_api_key", max_retries=3)
-            assert "Using API key from --api-key argument." in log_capture.text
-        finally:
-            os.chdir(original_cwd)
-            if dot_env_file.exists():
-                dot_env_file.unlink()
-
-    def test_shell_env_overrides_dotenv(
-        self, temp_csv_file: Path, temp_output_dir_for_cli: Path, monkeypatch, tmp_path, log_capture
-    ):
-        # Set shell env var
-        monkeypatch.setenv("ELEVENLABS_API_KEY", "shell_env_api_key")
-        
-        # Create .env file
-        dot_env_file = tmp_path / ".env"
-        dot_env_file.write_text('ELEVENLABS_API_KEY="dotenv_api_key"')
-        
-        original_cwd = os.getcwd()
-        os.chdir(tmp_path)
-
-        try:
-            with mock.patch("sfx_batch.main.SFXClient") as MockedSFXClientInstance: # Changed sfxbatch to sfx_batch
-                mock_sfx_instance = MockedSFXClientInstance.return_value
-                mock_sfx_instance.generate_sound_effect.return_value = b"mock_audio"
-
-                result = runner.invoke(app, [
-                    str(temp_csv_file),
-                    "--prompt-column", "0",
-                    # No CLI key
-                    "--output-dir", str(temp_output_dir_for_cli)
-                ])
-            
-            assert result.exit_code == 0, result.stdout
-            # python-dotenv's load_dotenv by default does NOT override existing shell env vars.
-            MockedSFXClientInstance.assert_called_once_with(api_key="shell_env_api_key", max_retries=3)
-            assert "Using API key from ELEVENLABS_API_KEY environment variable." in log_capture.text
-        finally:
-            os.chdir(original_cwd)
-            if dot_env_file.exists():
-                dot_env_file.unlink()
-    
-    def test_no_dotenv_file_found(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, monkeypatch, log_capture):
+        assert result.exit_code == 0, result.stdout
+        assert (fake_sfx_client.last.api_key, fake_sfx_client.last.max_retries) == (expected_key, 0)
+        if expected_key == "dotenv_api_key":
+            assert ".env file loaded." in log_capture_debug # Check if load_dotenv reported success
+        assert expected_log in log_capture_debug
+
+    @pytest.mark.dotenv
+    def test_no_dotenv_file_found(self, temp_csv_file: Path, temp_output_dir_for_cli: Path, monkeypatch, tmp_path, log_capture_debug):
         # Ensure no shell env var for API key that could be picked up
         monkeypatch.delenv("ELEVENLABS_API_KEY", raising=False)
         # Ensure no .env file exists in CWD (tmp_path for this test)
+        monkeypatch.chdir(tmp_path)
         
         # We expect this to fail because no API key is provided by any means
         result = runner.invoke(app, [
@@ -478,5 +625,120 @@ class TestCliMain:
         ])
         
         assert result.exit_code == 1 # Should fail due to missing API key
-        assert "No .env file found or it is empty." in log_capture.text
-        assert "ElevenLabs API key not found" in log_capture.text # Error from get_api_key
+        assert "No .env file found or it is empty." in log_capture_debug
+        assert "ElevenLabs API key not found" in log_capture_debug # Error from get_api_key
+
+
+class TestIterPrompts:
+    def test_yields_validated_rows_lazily(self):
+        header = ["prompt", "duration"]
+        data = [
+            ['"Thunder"', "2.5"],
+            [],                   # Empty row, skipped
+            ["", "3.0"],          # Empty prompt, skipped
+            ["Wind", "99"],       # Out-of-range duration, falls back to default
+            ["Rain"],             # Missing duration column, falls back to default
+        ]
+        consumed = []
+
+        def rows():
+            for row in data:
+                consumed.append(row)
+                yield row
+
+        prompts = iter_prompts(rows(), header, "test.csv", 0, 1, -1, 5.0, 0.3)
+
+        assert next(prompts) == {"text": "Thunder", "row_num": 2, "duration": 2.5, "influence": 0.3}
+        assert len(consumed) == 1 # Rows are only read on demand
+        assert list(prompts) == [
+            {"text": "Wind", "row_num": 5, "duration": 5.0, "influence": 0.3},
+            {"text": "Rain", "row_num": 6, "duration": 5.0, "influence": 0.3},
+        ]
+
+    def test_malformed_rows_are_skipped(self, log_capture_info):
+        header = ["notes", "prompt", "influence"]
+        rows = iter([["only notes"], ["n", "Rain", "bad"], ["n", "Wind"]])
+        prompts = list(iter_prompts(rows, header, "test.csv", 1, -1, 2, 5.0, 0.3))
+        assert [p["text"] for p in prompts] == ["Rain", "Wind"]
+        assert "Skipping malformed row 2 in test.csv (expected at least 2 columns, found 1)." in log_capture_info
+        assert "1 row had an invalid influence in CSV column 'influence'; used global influence 0.3 (first: row 3)." in log_capture_info
+        assert "1 row lacked influence column 'influence'; used global influence 0.3 (first: row 4)." in log_capture_info
+
+
+class TestIterPromptsVectorized:
+    HEADER = ["prompt", "duration", "influence"]
+    ROWS = [
+        ["Thunder", "2.5", "0.7"],
+        [],                          # Empty row
+        ["", "3.0", "0.1"],          # Empty prompt
+        ["Wind", "99", "1.5"],       # Out of range
+        ["Rain", " 4 ", "abc"],      # Whitespace around a number; invalid influence
+        ["Fire", "", "nan"],         # Empty duration; NaN is out of range, as with float()
+        ["Sea"],                     # Missing columns
+        ["Snow", "1e1", "+.5"],
+    ]
+
+    @pytest.mark.parametrize("chunk_size", [1, 3, 100])
+    def test_matches_iter_prompts(self, chunk_size):
+        pytest.importorskip("numpy")
+        pytest.importorskip("pyarrow")
+        expected = list(iter_prompts(iter(self.ROWS), self.HEADER, "test.csv", 0, 1, 2, 5.0, 0.3))
+        vectorized = iter_prompts_vectorized(iter(self.ROWS), self.HEADER, "test.csv", 0, 1, 2, 5.0, 0.3, chunk_size=chunk_size)
+        assert list(vectorized) == expected
+
+    def test_warnings_are_aggregated(self, log_capture_info):
+        pytest.importorskip("numpy")
+        pytest.importorskip("pyarrow")
+        list(iter_prompts_vectorized(iter(self.ROWS), self.HEADER, "test.csv", 0, 1, 2, 5.0, 0.3, chunk_size=2))
+        assert "2 rows had an influence out of range (0.0-1.0) in CSV column 'influence'; used global influence 0.3 (first: row 5, row 7)." in log_capture_info
+        assert "1 row had an invalid influence in CSV column 'influence'" in log_capture_info
+        assert "1 row lacked duration column 'duration'" in log_capture_info
+        assert "Invalid influence value" not in log_capture_info # No per-row numeric warnings
+
+
+class TestCallWithRetry:
+    @pytest.fixture
+    def sleeps(self, monkeypatch):
+        delays = []
+
+        async def fake_sleep(delay):
+            delays.append(delay)
+
+        monkeypatch.setattr(asyncio, "sleep", fake_sleep)
+        return delays
+
+    @staticmethod
+    def flaky(errors, result=b"audio"):
+        """Returns an async callable that raises each of `errors` in turn, then returns `result`."""
+        errors = list(errors)
+
+        async def fn():
+            if errors:
+                raise errors.pop(0)
+            return result
+        return fn
+
+    def test_retries_with_exponential_backoff(self, sleeps):
+        fn = self.flaky([ElevenLabsGenerationError("boom"), ElevenLabsRateLimitError("slow down")])
+        assert asyncio.run(_call_with_retry(fn, max_retries=3, base=0.5)) == b"audio"
+        assert len(sleeps) == 2
+        assert 0.5 <= sleeps[0] <= 1.0 # base * 2**0 + jitter
+        assert 1.0 <= sleeps[1] <= 1.5 # base * 2**1 + jitter
+
+    def test_honors_retry_after(self, sleeps):
+        error = ElevenLabsRateLimitError("slow down")
+        error.retry_after = 7
+        assert asyncio.run(_call_with_retry(self.flaky([error]), max_retries=1, base=0.5)) == b"audio"
+        assert 7.0 <= sleeps[0] <= 7.5
+
+    def test_reraises_after_max_retries(self, sleeps):
+        fn = self.flaky([ElevenLabsRateLimitError("slow down")] * 3)
+        with pytest.raises(ElevenLabsRateLimitError):
+            asyncio.run(_call_with_retry(fn, max_retries=2, base=0))
+        assert len(sleeps) == 2
+
+    def test_other_errors_are_not_retried(self, sleeps):
+        fn = self.flaky([ElevenLabsParameterError("bad duration")])
+        with pytest.raises(ElevenLabsParameterError):
+            asyncio.run(_call_with_retry(fn, max_retries=3))
+        assert sleeps == []